@@ -0,0 +1,132 @@
+# Serving static files and uploads
+#
+# Static files are linked through asset(), which adds a fingerprint of the
+# file's content to its URL (styles.css?v=3fa2c19b0d1e), so they can be
+# cached for a year and a changed file still gets fetched straight away.
+# Uploads are named after their content, so they are cached the same way.
+# CSS, JavaScript and SVG files are compressed once, by the gunicorn master
+# before any workers start or else when the app starts, and the .gz copy is
+# sent to browsers that accept gzip.  Range requests are answered with just
+# the bytes asked for.
+#
+# The file itself can be handed to the web server in front of the app rather
+# than sent by a Python worker, with STATIC_OFFLOAD:
+#   ''         - the worker sends it (gunicorn uses sendfile() for this)
+#   x-sendfile - Apache mod_xsendfile or lighttpd, with an X-Sendfile header
+#   x-accel    - nginx, with an X-Accel-Redirect header to an internal
+#                location for each folder, e.g.
+#                  location /_static/ {
+#                      internal; alias /srv/catalog/static/;
+#                  }
+#                  location /_uploads/ {
+#                      internal; alias /srv/catalog/images/;
+#                  }
+#                nginx's gzip_static module serves the .gz copies.
+import gzip
+import hashlib
+import mimetypes
+import os
+import shutil
+import tempfile
+import threading
+
+from flask import current_app, request, send_from_directory
+from werkzeug.exceptions import NotFound
+
+try:
+    from werkzeug.security import safe_join
+except ImportError:
+    from flask import safe_join
+
+# a year, the longest browsers are asked to keep a file
+FOREVER = 365 * 24 * 3600
+
+PRECOMPRESSED = ('.css', '.js', '.svg')
+
+fingerprints = {}
+fingerprints_lock = threading.Lock()
+
+
+def fingerprint(folder, filename):
+    # a short hash of the file's content, worked out again when it changes
+    path = os.path.join(folder, filename)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    key = (path, mtime)
+    with fingerprints_lock:
+        if key in fingerprints:
+            return fingerprints[key]
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    with fingerprints_lock:
+        fingerprints[key] = digest.hexdigest()[:12]
+    return fingerprints[key]
+
+
+def precompress(folder):
+    # write a .gz copy of every compressible file that doesn't have an up to
+    # date one
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            if not name.endswith(PRECOMPRESSED):
+                continue
+            path = os.path.join(root, name)
+            if (os.path.exists(path + '.gz') and
+                    os.path.getmtime(path + '.gz') >= os.path.getmtime(path)):
+                continue
+            # each process writes a temporary file of its own, so workers
+            # starting at once don't trip over each other's
+            fd, temporary = tempfile.mkstemp(prefix=name + '.', suffix='.tmp',
+                                             dir=root)
+            try:
+                with open(path, 'rb') as source:
+                    with os.fdopen(fd, 'wb') as f:
+                        with gzip.GzipFile(name, 'wb', 9, f) as target:
+                            shutil.copyfileobj(source, target)
+                # readable by the web server too, like the file itself
+                os.chmod(temporary, os.stat(path).st_mode & 0o777)
+                os.rename(temporary, path + '.gz')
+            except Exception:
+                os.remove(temporary)
+                raise
+
+
+def send(folder, filename, accel_prefix, max_age=None):
+    # a response for a file in folder - max_age is in seconds, and files
+    # whose URL changes with their content are kept FOREVER
+    path = safe_join(folder, filename)
+    if path is None or not os.path.isfile(path):
+        raise NotFound()
+
+    mimetype = mimetypes.guess_type(filename)[0] or \
+        'application/octet-stream'
+    encoding = None
+    if (filename.endswith(PRECOMPRESSED) and
+            request.accept_encodings['gzip'] and
+            os.path.isfile(path + '.gz')):
+        filename += '.gz'
+        encoding = 'gzip'
+
+    if current_app.config['STATIC_OFFLOAD'] == 'x-accel':
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = accel_prefix + filename
+    else:
+        # conditional answers If-None-Match and Range headers
+        response = send_from_directory(folder, filename, mimetype=mimetype,
+                                       conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if filename.endswith(PRECOMPRESSED + ('.gz',)):
+        response.vary.add('Accept-Encoding')
+
+    if max_age == FOREVER:
+        response.headers['Cache-Control'] = \
+            'public, max-age=%d, immutable' % FOREVER
+    elif max_age is not None:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    return response
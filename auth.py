@@ -0,0 +1,161 @@
+# Outbound calls to the Google and Facebook login providers
+# The client secrets are read and the Google OAuth flow is built once, when
+# the app starts.  Connections to the providers are pooled and kept alive
+# between logins, every call has a timeout (AUTH_TIMEOUT seconds), and the
+# result of checking a Google access token is remembered until the token
+# expires.  The provider URLs come from config.py, so they can be pointed at
+# a local stand-in for testing (see benchmarks/providers.py).
+#
+# Calls that don't depend on each other run at the same time on a pool of
+# provider threads, and a login gives up once AUTH_DEADLINE seconds have
+# passed, so a slow provider can't hold a server worker for long.  Tokens are
+# revoked on logout by a background job (see jobs.py), after the user has
+# already been logged out.
+import hashlib
+import json
+import logging
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+import httplib2
+import requests
+from requests.adapters import HTTPAdapter
+from oauth2client.client import flow_from_clientsecrets
+
+from cache import LocalCache
+
+log = logging.getLogger(__name__)
+
+
+class ProviderTimeout(Exception):
+    # a login provider didn't answer before the deadline
+    pass
+
+
+class Providers(object):
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.timeout = settings['AUTH_TIMEOUT']
+
+        with open(settings['GOOGLE_CLIENT_SECRETS']) as f:
+            self.google_secrets = json.load(f)['web']
+        with open(settings['FACEBOOK_CLIENT_SECRETS']) as f:
+            self.facebook_secrets = json.load(f)['web']
+        self.client_id = self.google_secrets['client_id']
+
+        # the flow only holds configuration, so one can serve every login
+        self.flow = flow_from_clientsecrets(settings['GOOGLE_CLIENT_SECRETS'],
+                                            scope='',
+                                            redirect_uri='postmessage')
+        if settings['GOOGLE_TOKEN_URL']:
+            self.flow.token_uri = settings['GOOGLE_TOKEN_URL']
+
+        # requests sessions are safe to share between threads and keep a
+        # pool of open connections per host
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4,
+                              pool_maxsize=settings['AUTH_POOL_SIZE'])
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # oauth2client needs an httplib2 client, which isn't thread safe, so
+        # each thread keeps its own
+        self.local = threading.local()
+
+        self.tokens = LocalCache(settings['AUTH_TOKEN_CACHE_SIZE'])
+
+        self.pool = ThreadPool(settings['AUTH_WORKERS'])
+
+    def deadline(self):
+        # the time by which a login started now must have finished
+        return time.time() + self.settings['AUTH_DEADLINE']
+
+    def concurrently(self, deadline, *calls):
+        # run each (function, arg, ...) call on the provider pool at the same
+        # time and return their results in order, raising ProviderTimeout if
+        # they haven't all finished by the deadline
+        pending = [self.pool.apply_async(call[0], call[1:]) for call in calls]
+        try:
+            return [result.get(max(0, deadline - time.time()))
+                    for result in pending]
+        except TimeoutError:
+            raise ProviderTimeout()
+
+    def call(self, deadline, function, *args):
+        return self.concurrently(deadline, (function,) + args)[0]
+
+    def revoke(self, provider, credential):
+        # revoke a Google access token or Facebook permissions.  A provider
+        # that can't be reached raises, so the job is tried again; a refusal
+        # (e.g. for a token that has already expired) is only logged.
+        if provider == 'google':
+            status = self.google_revoke(credential)
+        else:
+            status = self.facebook_revoke(credential)
+        if status != 200:
+            log.warning('%s revoke failed with status %s', provider, status)
+
+    def oauth_http(self):
+        if not hasattr(self.local, 'http'):
+            self.local.http = httplib2.Http(timeout=self.timeout)
+        return self.local.http
+
+    def get(self, url, **params):
+        return self.session.get(url, params=params, timeout=self.timeout)
+
+    # Google
+
+    def google_exchange(self, code):
+        # exchange an authorization code for a credentials object
+        return self.flow.step2_exchange(code, http=self.oauth_http())
+
+    def google_tokeninfo(self, access_token):
+        # check an access token, remembering a good answer until it expires
+        key = 'token:' + hashlib.sha256(
+            access_token.encode('utf-8')).hexdigest()
+        result = self.tokens.get(key)
+        if result is None:
+            result = self.get(self.settings['GOOGLE_TOKENINFO_URL'],
+                              access_token=access_token).json()
+            expires_in = int(result.get('expires_in', 0))
+            if result.get('error') is None and expires_in > 0:
+                self.tokens.set(key, result, expires_in)
+        return result
+
+    def google_userinfo(self, access_token):
+        return self.get(self.settings['GOOGLE_USERINFO_URL'],
+                        access_token=access_token, alt='json').json()
+
+    def google_revoke(self, access_token):
+        # returns the HTTP status of the revoke request
+        self.tokens.delete('token:' + hashlib.sha256(
+            access_token.encode('utf-8')).hexdigest())
+        return self.get(self.settings['GOOGLE_REVOKE_URL'],
+                        token=access_token).status_code
+
+    # Facebook
+
+    def facebook_exchange(self, access_token):
+        # exchange a client token for a long-lived server-side token, which
+        # is returned as a query string such as access_token=...
+        reply = self.get(self.settings['FACEBOOK_GRAPH_URL'] +
+                         '/oauth/access_token',
+                         grant_type='fb_exchange_token',
+                         client_id=self.facebook_secrets['app_id'],
+                         client_secret=self.facebook_secrets['app_secret'],
+                         fb_exchange_token=access_token)
+        # strip the expiry from the token
+        return reply.text.split('&')[0]
+
+    def facebook_userinfo(self, token):
+        url = '%s/v2.2/me?%s&fields=name,id,email' % (
+            self.settings['FACEBOOK_GRAPH_URL'], token)
+        return self.session.get(url, timeout=self.timeout).json()
+
+    def facebook_revoke(self, facebook_id):
+        url = '%s/%s/permissions' % (self.settings['FACEBOOK_GRAPH_URL'],
+                                     facebook_id)
+        return self.session.delete(url, timeout=self.timeout).status_code
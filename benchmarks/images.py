@@ -0,0 +1,69 @@
+# Measure how many image requests a single worker process serves per second.
+# The catalog is run in this process behind a threaded WSGI server, against
+# a throwaway database, and the largest image in the images folder is
+# requested whole, as a range of its first 64KB, and as a conditional
+# request answered with a 304.
+#
+# usage: python benchmarks/images.py [requests] [threads]
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import requests
+
+from login import run_concurrently
+from routes import serve
+
+
+def main(count=2000, threads=8):
+    os.chdir(ROOT)
+    directory = tempfile.mkdtemp()
+    try:
+        os.environ['CATALOG_DATABASE_URL'] = 'sqlite:///' + os.path.join(
+            directory, 'bench.db')
+        os.environ['CATALOG_SESSION_FILE'] = os.path.join(directory,
+                                                          'sessions.db')
+        os.environ['CATALOG_SECRET_KEY'] = 'benchmark'
+
+        import catalog
+        app = catalog.create_app(migrate=True)
+        folder = app.config['UPLOAD_FOLDER']
+        filename = max((f for f in os.listdir(folder)
+                        if os.path.isfile(os.path.join(folder, f))),
+                       key=lambda f: os.path.getsize(os.path.join(folder, f)))
+        size = os.path.getsize(os.path.join(folder, filename))
+        server, base = serve(app)
+        url = base + '/uploads/' + filename
+        etag = requests.get(url).headers['ETag']
+
+        print('%s, %d bytes, %d threads' % (filename, size, threads))
+        print('%-12s %10s %10s' % ('request', 'requests/s', 'MB/s'))
+        for name, headers, status in [
+                ('whole', {}, 200),
+                ('range', {'Range': 'bytes=0-65535'}, 206),
+                ('304', {'If-None-Match': etag}, 304)]:
+            local = threading.local()
+            sent = [0]
+
+            def fetch(n):
+                if not hasattr(local, 'session'):
+                    local.session = requests.Session()
+                response = local.session.get(url, headers=headers)
+                assert response.status_code == status, response.status_code
+                sent[0] += len(response.content)
+
+            elapsed = run_concurrently(fetch, count, threads)
+            print('%-12s %10.1f %10.1f' % (name, count / elapsed,
+                                           sent[0] / elapsed / 1e6))
+        server.shutdown()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,93 @@
+# Measure Google and Facebook login throughput against the local stand-in
+# providers (see providers.py), using a throwaway database.  Each login is a
+# full /gconnect or /fbconnect call through the Flask test client, from a
+# number of threads at once.
+#
+# usage: python benchmarks/login.py [logins] [threads] [provider delay ms]
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import providers
+
+USERS = 100
+
+
+def run_concurrently(function, count, threads):
+    # call function(n) for n in range(count) from a number of threads,
+    # returning the elapsed time in seconds.  A thread that fails stops, and
+    # the first failure is raised again once the others have finished.
+    failures = []
+
+    def worker(start):
+        try:
+            for n in range(start, count, threads):
+                function(n)
+        except Exception:
+            failures.append(sys.exc_info())
+
+    workers = [threading.Thread(target=worker, args=(start,))
+               for start in range(threads)]
+    started = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - started
+    if failures:
+        traceback.print_exception(*failures[0])
+        raise RuntimeError('%d of %d threads failed, the first with %r' % (
+            len(failures), threads, failures[0][1]))
+    return elapsed
+
+
+def main(logins=1000, threads=8, delay_ms=0):
+    os.chdir(ROOT)
+    with open('client_secrets.json') as f:
+        client_id = json.load(f)['web']['client_id']
+    server, settings = providers.serve(client_id, delay_ms / 1000.0)
+    directory = tempfile.mkdtemp()
+    try:
+        for name, value in settings.items():
+            os.environ['CATALOG_' + name] = value
+        os.environ['CATALOG_DATABASE_URL'] = 'sqlite:///' + os.path.join(
+            directory, 'bench.db')
+        os.environ['CATALOG_SECRET_KEY'] = 'benchmark'
+        # every login comes from this one address, as fast as it can
+        os.environ['CATALOG_RATE_LIMIT_BACKEND'] = 'none'
+
+        import catalog
+        app = catalog.create_app(migrate=True)
+
+        def login(path, n):
+            client = app.test_client()
+            with client.session_transaction() as login_session:
+                login_session['state'] = 'benchmark'
+            response = client.post(path + '?state=benchmark',
+                                   data=str(n % USERS))
+            assert response.status_code == 200, response.data
+
+        # create the users first, so the timed logins don't race to do it
+        for n in range(USERS):
+            login('/gconnect', n)
+
+        for path in ('/gconnect', '/fbconnect'):
+            elapsed = run_concurrently(lambda n: login(path, n), logins,
+                                       threads)
+            print('%-12s %6d logins %8.1f logins/s %8.2f ms each' % (
+                path, logins, logins / elapsed, elapsed * 1000 / logins))
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,94 @@
+# Benchmark the category page and login lookups with and without the indexes
+# added in schema version 2.  A throwaway sqlite database is seeded with
+# synthetic users, categories and items, the queries run by itemsByCategory
+# and getUserID are timed with the indexes dropped, and again after they
+# have been created.
+#
+# usage: python benchmarks/lookup_indexes.py [items] [categories] [runs]
+import os
+import sys
+import shutil
+import tempfile
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from sqlalchemy.orm import sessionmaker
+from database_setup import Base, User, Category, Item, get_engine
+import config
+
+USERS = 1000
+BATCH_SIZE = 10000
+
+
+def seed(engine, items, categories):
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [
+            {'name': 'user %d' % n, 'email': 'user%d@example.com' % n}
+            for n in range(1, USERS + 1)])
+        connection.execute(Category.__table__.insert(), [
+            {'name': 'category %d' % n, 'description': 'category %d' % n,
+             'user_id': random.randint(1, USERS)}
+            for n in range(1, categories + 1)])
+
+    # items are inserted in batches so the whole catalog is never in memory
+    for start in range(0, items, BATCH_SIZE):
+        rows = [{'name': 'item %d' % n, 'description': 'item %d' % n,
+                 'price': '9.99', 'category_id': random.randint(1, categories),
+                 'user_id': random.randint(1, USERS)}
+                for n in range(start, min(start + BATCH_SIZE, items))]
+        with engine.begin() as connection:
+            connection.execute(Item.__table__.insert(), rows)
+
+
+def time_queries(session, categories, runs):
+    # mean milliseconds for the category page query and the login lookup
+    start = time.time()
+    for n in range(runs):
+        session.query(Item).filter_by(
+            category_id=random.randint(1, categories)).all()
+        session.expunge_all()
+    category_ms = (time.time() - start) * 1000 / runs
+
+    start = time.time()
+    for n in range(runs):
+        session.query(User).filter_by(
+            email='user%d@example.com' % random.randint(1, USERS)).one()
+    login_ms = (time.time() - start) * 1000 / runs
+
+    return category_ms, login_ms
+
+
+def main(items=1000000, categories=100, runs=20):
+    directory = tempfile.mkdtemp()
+    try:
+        engine = get_engine(config.settings(
+            DATABASE_URL='sqlite:///' + os.path.join(directory, 'bench.db')))
+        print('seeding %d items in %d categories...' % (items, categories))
+        seed(engine, items, categories)
+        session = sessionmaker(bind=engine)()
+
+        indexes = [index for table in Base.metadata.sorted_tables
+                   for index in table.indexes]
+        for index in indexes:
+            index.drop(engine)
+        before = time_queries(session, categories, runs)
+
+        for index in indexes:
+            index.create(engine)
+        after = time_queries(session, categories, runs)
+
+        print('%-20s %12s %12s' % ('query', 'before (ms)', 'after (ms)'))
+        print('%-20s %12.2f %12.2f' % ('category page', before[0], after[0]))
+        print('%-20s %12.2f %12.2f' % ('user by email', before[1], after[1]))
+        session.close()
+        engine.dispose()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,113 @@
+# A local stand-in for the Google and Facebook login APIs
+# Answers the calls made by auth.py with canned users, so logins can be
+# exercised and measured without network access.  Every access token it
+# hands out is valid, and each authorization code or Facebook token logs in
+# a user derived from it, e.g. code "7" logs in user7@example.com.
+#
+# serve() runs it on a local port in a background thread and returns the
+# settings (see config.py) that point the catalog at it.
+import base64
+import json
+import threading
+import time
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+try:
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+except ImportError:
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+
+from wsgiref.simple_server import WSGIServer
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+def id_token(subject):
+    # an unsigned JWT - oauth2client only decodes the payload
+    def encode(value):
+        return base64.urlsafe_b64encode(
+            json.dumps(value).encode('utf-8')).decode('ascii').rstrip('=')
+    return '%s.%s.' % (encode({'alg': 'none'}), encode({'sub': subject}))
+
+
+def make_app(client_id, delay=0):
+    # delay is the number of seconds every call takes, to imitate a slow
+    # provider
+
+    def app(environ, start_response):
+        if delay:
+            time.sleep(delay)
+        path = environ['PATH_INFO']
+        query = dict((k, v[0]) for k, v in
+                     parse_qs(environ.get('QUERY_STRING', '')).items())
+        if environ['REQUEST_METHOD'] == 'POST':
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            body = environ['wsgi.input'].read(length).decode('utf-8')
+            query.update((k, v[0]) for k, v in parse_qs(body).items())
+
+        content_type = 'application/json'
+        if path == '/google/token':
+            # the access token carries the user number through
+            user = query.get('code', '1')
+            body = {'access_token': 'google-%s' % user,
+                    'token_type': 'Bearer', 'expires_in': 3600,
+                    'id_token': id_token(user)}
+        elif path == '/google/tokeninfo':
+            user = query['access_token'].split('-', 1)[1]
+            body = {'user_id': user, 'issued_to': client_id,
+                    'expires_in': 3600}
+        elif path == '/google/userinfo':
+            user = query['access_token'].split('-', 1)[1]
+            body = {'name': 'User %s' % user,
+                    'email': 'user%s@example.com' % user}
+        elif path == '/google/revoke':
+            body = {}
+        elif path == '/facebook/oauth/access_token':
+            content_type = 'text/plain'
+            body = 'access_token=facebook-%s&expires=5183999' % (
+                query['fb_exchange_token'])
+        elif path == '/facebook/v2.2/me':
+            user = query['access_token'].split('-', 1)[1]
+            body = {'id': user, 'name': 'User %s' % user,
+                    'email': 'user%s@example.com' % user}
+        elif path.startswith('/facebook/') and \
+                path.endswith('/permissions'):
+            body = {'success': True}
+        else:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'not found']
+
+        if content_type == 'application/json':
+            body = json.dumps(body)
+        start_response('200 OK', [('Content-Type', content_type)])
+        return [body.encode('utf-8')]
+
+    return app
+
+
+def serve(client_id, delay=0):
+    server = make_server('127.0.0.1', 0, make_app(client_id, delay),
+                         server_class=ThreadingWSGIServer,
+                         handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    base = 'http://127.0.0.1:%d' % server.server_port
+    return server, {
+        'GOOGLE_TOKEN_URL': base + '/google/token',
+        'GOOGLE_TOKENINFO_URL': base + '/google/tokeninfo',
+        'GOOGLE_USERINFO_URL': base + '/google/userinfo',
+        'GOOGLE_REVOKE_URL': base + '/google/revoke',
+        'FACEBOOK_GRAPH_URL': base + '/facebook',
+    }
@@ -0,0 +1,154 @@
+# Run writers and readers against the catalog at once, to check the read
+# routing (see routing.py) and measure how the two get on.  A throwaway sqlite
+# database is seeded as in routes.py and served over HTTP from this process.
+#
+# Each writer logs in and keeps moving an item of its own between two
+# categories, and straight after each edit reads the item back - it must see
+# its own change (read-your-writes).  Each reader keeps fetching /catalog/json
+# and /categories/json, and every writer's item must appear exactly once in
+# each catalog it reads, as the item and both categories' snapshots change
+# in one transaction.
+#
+# The script exits with status 1 if any read was stale or inconsistent.  Run
+# it again with CATALOG_READ_ROUTING=0 to compare with reading the primary.
+#
+# usage: python benchmarks/read_routing.py [seconds] [writers] [readers]
+#            [items]
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import providers
+from routes import HttpClient, form, login, make_targets, percentile, seed
+from routes import serve
+
+
+class Results(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {'write': [], 'read': []}
+        self.statuses = {}
+        self.stale = 0
+        self.inconsistent = 0
+
+    def add(self, kind, started, status):
+        with self.lock:
+            self.latencies[kind].append(time.time() - started)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+
+def writer(base, item_id, categories, deadline, results):
+    client = login(HttpClient(base))
+    n = 0
+    while time.time() < deadline:
+        n += 1
+        name = 'moved %d' % n
+        started = time.time()
+        status, page = client.request(
+            'POST', '/item/%d/edit' % item_id,
+            form(name, price='1.00', category=categories[n % 2]))
+        results.add('write', started, status)
+        if status != 302:
+            continue
+        status, body = client.request('GET', '/item/%d/json' % item_id)
+        if status != 200 or json.loads(body)['item'][0]['name'] != name:
+            with results.lock:
+                results.stale += 1
+
+
+def reader(base, moving, deadline, results):
+    client = HttpClient(base)
+    n = 0
+    while time.time() < deadline:
+        n += 1
+        path = '/catalog/json' if n % 2 else '/categories/json'
+        started = time.time()
+        status, body = client.request('GET', path)
+        results.add('read', started, status)
+        if status != 200 or path != '/catalog/json':
+            continue
+        seen = dict((item_id, 0) for item_id in moving)
+        for category in json.loads(body)['catalog'][0]:
+            for item in category['items']:
+                if item['id'] in seen:
+                    seen[item['id']] += 1
+        if any(count != 1 for count in seen.values()):
+            with results.lock:
+                results.inconsistent += 1
+
+
+def main(seconds=10, writers=4, readers=8, items=1000):
+    os.chdir(ROOT)
+    with open('client_secrets.json') as f:
+        client_id = json.load(f)['web']['client_id']
+    provider_server, settings = providers.serve(client_id)
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'bench.db')
+        settings['DATABASE_URL'] = 'sqlite:///' + path
+        settings['SESSION_FILE'] = os.path.join(directory, 'sessions.db')
+        settings['SECRET_KEY'] = 'benchmark'
+        # the writers post as fast as they can
+        settings['RATE_LIMIT_BACKEND'] = 'none'
+        for name, value in settings.items():
+            os.environ['CATALOG_' + name] = value
+
+        from database_setup import get_engine
+        import config
+        engine = get_engine(config.settings(DATABASE_URL='sqlite:///' + path))
+        seed(engine, items, max(10, items // 1000))
+        # two categories per writer, the first with the item it moves
+        targets = make_targets(engine, writers * 2)
+
+        import catalog
+        app = catalog.create_app(migrate=True)
+        server, base = serve(app)
+        results = Results()
+        deadline = time.time() + seconds
+        threads = [threading.Thread(target=writer, args=(
+            base, targets[2 * w][1], (targets[2 * w][0],
+                                      targets[2 * w + 1][0]),
+            deadline, results)) for w in range(writers)]
+        threads += [threading.Thread(target=reader, args=(
+            base, [targets[2 * w][1] for w in range(writers)], deadline,
+            results)) for r in range(readers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        server.shutdown()
+        engine.dispose()
+    finally:
+        provider_server.shutdown()
+        shutil.rmtree(directory)
+
+    print('read routing %s, %d writers, %d readers, %ds' % (
+        'on' if catalog.read_engine is not None else 'off', writers, readers,
+        seconds))
+    print('%-8s %10s %10s %10s %10s' % ('', 'requests', 'per second',
+                                        'p50 (ms)', 'p99 (ms)'))
+    for kind in ('write', 'read'):
+        latencies = results.latencies[kind]
+        if not latencies:
+            continue
+        print('%-8s %10d %10.1f %10.2f %10.2f' % (
+            kind, len(latencies), len(latencies) / float(seconds),
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000))
+    print('statuses %s' % ', '.join('%s: %d' % item for item in
+                                     sorted(results.statuses.items())))
+    print('stale reads of own writes %d, inconsistent catalogs %d' % (
+        results.stale, results.inconsistent))
+    return 1 if results.stale or results.inconsistent else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*[int(arg) for arg in sys.argv[1:]]))
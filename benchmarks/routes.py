@@ -0,0 +1,517 @@
+# Benchmark every route in catalog.py
+# A sqlite database is seeded with synthetic users, categories and items at
+# one of the SCALES, and each route is called a number of times, first
+# through the Flask test client and then over HTTP through a threaded WSGI
+# server.  The Google and Facebook logins go to the local stand-in providers
+# (see providers.py).  The write routes log in as an operator, and metrics
+# are switched on, so /jobs/json and /metrics are called too.
+#
+# For every route the results give the p50 and p99 latency, requests per
+# second, database queries per request and how far the route raised the
+# peak resident memory of the process, in kilobytes (routes that stay within
+# the peak reached before them show 0).  They are written as JSON, so the
+# results of two releases can be compared:
+#
+# usage: python benchmarks/routes.py run [--scale small|medium|large|items]
+#            [--requests 200] [--threads 8] [--mode client|server|both]
+#            [--database bench.db] [--output results.json]
+#        python benchmarks/routes.py compare old.json new.json
+#
+# Seeding the large scale takes a while - with --database the seeded file is
+# kept and reused by later runs.  Write routes change the data, so a kept
+# database drifts a little from run to run.
+import argparse
+import io
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import providers
+from login import run_concurrently
+
+# items at each scale - there is a category for every 1000 items (at least
+# 10) and USERS users
+SCALES = {'small': 1000, 'medium': 100000, 'large': 1000000}
+USERS = 1000
+BATCH_SIZE = 10000
+
+# the user the write routes log in as - providers.py logs in user N for
+# code N, and seeded user N has the same email.  They are also an operator,
+# to see /jobs/json.
+OWNER = 1
+OWNER_EMAIL = 'user%d@example.com' % OWNER
+
+
+def seed(engine, items, categories):
+    from database_setup import User, Category, Item
+    from migrations import upgrade
+    import snapshot
+
+    upgrade(engine)
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [
+            {'name': 'User %d' % n, 'email': 'user%d@example.com' % n}
+            for n in range(1, USERS + 1)])
+        connection.execute(Category.__table__.insert(), [
+            {'name': 'category %d' % n,
+             'description': 'description of category %d' % n,
+             'user_id': random.randint(1, USERS)}
+            for n in range(1, categories + 1)])
+
+    # items are inserted in batches so the whole catalog is never in memory
+    for start in range(0, items, BATCH_SIZE):
+        rows = [{'name': 'item %d' % n,
+                 'description': 'description of item %d' % n,
+                 'price': '%d.99' % (n % 100),
+                 'category_id': random.randint(1, categories),
+                 'user_id': random.randint(1, USERS)}
+                for n in range(start + 1, min(start + BATCH_SIZE, items) + 1)]
+        with engine.begin() as connection:
+            connection.execute(Item.__table__.insert(), rows)
+
+    with engine.begin() as connection:
+        snapshot.rebuild(connection)
+
+
+def make_targets(engine, count):
+    # categories owned by OWNER, each with one item, for the edit and delete
+    # routes to change - returns their (category id, item id)s
+    from database_setup import Category, Item
+    import snapshot
+
+    targets = []
+    with engine.begin() as connection:
+        for n in range(count):
+            category_id = connection.execute(
+                Category.__table__.insert(),
+                {'name': 'target %d' % n,
+                 'description': 'benchmark target', 'user_id': OWNER}).\
+                inserted_primary_key[0]
+            item_id = connection.execute(
+                Item.__table__.insert(),
+                {'name': 'target item', 'description': 'benchmark target',
+                 'price': '1.00', 'category_id': category_id,
+                 'user_id': OWNER}).inserted_primary_key[0]
+            targets.append((category_id, item_id))
+        snapshot.rebuild(connection, [c for c, i in targets])
+    return targets
+
+
+class TestClient(object):
+    # requests through the Flask test client
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, form=None, body=None,
+                content_type=None):
+        # returns the status and the body, as bytes - not all of them are text
+        data = body
+        if form is not None:
+            # the forms all have an upload field - send it empty
+            data = dict(form, userfilename=(io.BytesIO(b''), 'none.txt'))
+        response = self.client.open(path, method=method, data=data,
+                                    content_type=content_type)
+        return response.status_code, response.get_data()
+
+
+class HttpClient(object):
+    # requests over HTTP, keeping the connection and cookies between them
+
+    def __init__(self, base):
+        import requests
+        self.base = base
+        self.session = requests.Session()
+
+    def request(self, method, path, form=None, body=None,
+                content_type=None):
+        files = None
+        if form is not None:
+            files = {'userfilename': ('none.txt', b'')}
+        headers = {'Content-Type': content_type} if content_type else None
+        response = self.session.request(method, self.base + path,
+                                        data=form if body is None else body,
+                                        files=files, headers=headers,
+                                        allow_redirects=False)
+        return response.status_code, response.content
+
+
+def login_state(client):
+    # the state token of a new login page
+    status, page = client.request('GET', '/login')
+    return re.search(r'state=(\w+)', page.decode('utf-8')).group(1)
+
+
+def login(client, provider='google', user=OWNER):
+    state = login_state(client)
+    path = '/gconnect' if provider == 'google' else '/fbconnect'
+    status, page = client.request('POST', path + '?state=' + state,
+                                  body=str(user))
+    assert status == 200, page
+    return client
+
+
+class Run(object):
+    # the state one benchmark mode needs to build its requests
+
+    def __init__(self, new_client, items, categories, targets, upload):
+        self.new_client = new_client
+        self.items = items
+        self.categories = categories
+        self.targets = targets
+        self.upload = upload
+        self.local = threading.local()
+
+    def guest(self):
+        # a client per thread that isn't logged in
+        if not hasattr(self.local, 'guest'):
+            self.local.guest = self.new_client()
+        return self.local.guest
+
+    def owner(self):
+        # a client per thread logged in as the owner of the targets
+        if not hasattr(self.local, 'owner'):
+            self.local.owner = login(self.new_client())
+        return self.local.owner
+
+    def category(self):
+        return random.randint(1, self.categories)
+
+    def item(self):
+        return random.randint(1, self.items)
+
+
+def form(name, **fields):
+    return dict(fields, name=name, description='benchmark ' + name)
+
+
+def batch(*operations):
+    return json.dumps({'operations': operations})
+
+
+# (name, setup) for every route, in the order they are run.  setup(run, n)
+# is called untimed before the n-th request and returns the client and the
+# arguments for its request.  The targets are deleted at the end, so the
+# edit and delete routes come last.
+ROUTES = [
+    ('GET /', lambda r, n: (r.guest(), 'GET', '/')),
+    ('GET /?after', lambda r, n: (
+        r.guest(), 'GET', '/?after=%d' % r.category())),
+    ('GET /category/<id>', lambda r, n: (
+        r.guest(), 'GET', '/category/%d' % r.category())),
+    ('GET /item/<id>/detail', lambda r, n: (
+        r.guest(), 'GET', '/item/%d/detail' % r.item())),
+    ('GET /categories/json', lambda r, n: (
+        r.guest(), 'GET', '/categories/json')),
+    ('GET /category/<id>/json', lambda r, n: (
+        r.guest(), 'GET', '/category/%d/json' % r.category())),
+    ('GET /catalog/json', lambda r, n: (
+        r.guest(), 'GET', '/catalog/json')),
+    ('GET /item/<id>/json', lambda r, n: (
+        r.guest(), 'GET', '/item/%d/json' % r.item())),
+    ('GET /search', lambda r, n: (
+        r.guest(), 'GET', '/search?q=item+%d' % r.item())),
+    ('GET /search/json', lambda r, n: (
+        r.guest(), 'GET', '/search/json?q=category+%d' % r.category())),
+    ('GET /uploads/<file>', lambda r, n: (
+        r.guest(), 'GET', '/uploads/' + r.upload)),
+    ('GET /static/<file>', lambda r, n: (
+        r.guest(), 'GET', '/static/styles.css')),
+    ('GET /metrics', lambda r, n: (r.guest(), 'GET', '/metrics')),
+    ('GET /jobs/json', lambda r, n: (r.owner(), 'GET', '/jobs/json')),
+    ('GET /login', lambda r, n: (r.new_client(), 'GET', '/login')),
+    ('POST /gconnect', lambda r, n: (
+        r.new_client(), 'POST', '/gconnect')),
+    ('POST /fbconnect', lambda r, n: (
+        r.new_client(), 'POST', '/fbconnect')),
+    ('GET /gdisconnect', lambda r, n: (
+        login(r.new_client()), 'GET', '/gdisconnect')),
+    ('GET /fbdisconnect', lambda r, n: (
+        login(r.new_client(), 'facebook'), 'GET', '/fbdisconnect')),
+    ('GET /logout', lambda r, n: (login(r.new_client()), 'GET', '/logout')),
+    ('GET /category/new', lambda r, n: (
+        r.owner(), 'GET', '/category/new')),
+    ('POST /category/new', lambda r, n: (
+        r.owner(), 'POST', '/category/new', form('new category %d' % n))),
+    ('GET /item/new/<id>', lambda r, n: (
+        r.owner(), 'GET', '/item/new/%d' % r.targets[n][0])),
+    ('POST /item/new/<id>', lambda r, n: (
+        r.owner(), 'POST', '/item/new/%d' % r.targets[n][0],
+        form('new item %d' % n, price='1.00',
+             category=r.targets[n][0]))),
+    ('GET /category/<id>/edit', lambda r, n: (
+        r.owner(), 'GET', '/category/%d/edit' % r.targets[n][0])),
+    ('POST /category/<id>/edit', lambda r, n: (
+        r.owner(), 'POST', '/category/%d/edit' % r.targets[n][0],
+        form('edited category %d' % n))),
+    ('GET /item/<id>/edit', lambda r, n: (
+        r.owner(), 'GET', '/item/%d/edit' % r.targets[n][1])),
+    ('POST /item/<id>/edit', lambda r, n: (
+        r.owner(), 'POST', '/item/%d/edit' % r.targets[n][1],
+        form('edited item %d' % n, price='2.00',
+             category=r.targets[n][0]))),
+    ('POST /items/batch', lambda r, n: (
+        r.owner(), 'POST', '/items/batch', None,
+        batch({'op': 'update', 'id': r.targets[n][1], 'price': '3.00'},
+              {'op': 'create', 'name': 'batch item %d' % n,
+               'category': r.targets[n][0]}),
+        'application/json')),
+    ('GET /item/<id>/delete', lambda r, n: (
+        r.owner(), 'GET', '/item/%d/delete' % r.targets[n][1])),
+    ('POST /item/<id>/delete', lambda r, n: (
+        r.owner(), 'POST', '/item/%d/delete' % r.targets[n][1], {})),
+    ('GET /category/<id>/delete', lambda r, n: (
+        r.owner(), 'GET', '/category/%d/delete' % r.targets[n][0])),
+    ('POST /category/<id>/delete', lambda r, n: (
+        r.owner(), 'POST', '/category/%d/delete' % r.targets[n][0], {})),
+]
+
+
+class QueryCounter(object):
+    # counts the statements run on the engines
+
+    def __init__(self, *engines):
+        from sqlalchemy import event
+        self.count = 0
+        self.lock = threading.Lock()
+        for engine in engines:
+            if engine is not None:
+                event.listen(engine, 'after_cursor_execute', self.add)
+
+    def add(self, *args):
+        with self.lock:
+            self.count += 1
+
+
+def percentile(values, p):
+    # nearest rank, or None if there are no values
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def milliseconds(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def peak_rss_kb():
+    # the peak resident memory of the process so far - ru_maxrss is in
+    # kilobytes on Linux but bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def measure(run, name, setup, requests, threads, queries):
+    # call one route requests times from a number of threads
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def call(n):
+        args = setup(run, n)
+        client = args[0]
+        if name in ('POST /gconnect', 'POST /fbconnect'):
+            # the timed part is the login call itself
+            args = (client, 'POST', '%s?state=%s' % (args[2],
+                                                     login_state(client)),
+                    None, str(OWNER))
+        started = time.time()
+        status, page = client.request(*args[1:])
+        elapsed = time.time() - started
+        with lock:
+            latencies.append(elapsed)
+            if status >= 400:
+                errors[0] += 1
+
+    queries_before = queries.count
+    peak_before = peak_rss_kb()
+    elapsed = run_concurrently(call, requests, threads)
+    # the setup of each request is counted in the elapsed time and queries,
+    # but not in the latencies
+    return {
+        'route': name,
+        'requests': requests,
+        'errors': errors[0],
+        'p50_ms': milliseconds(percentile(latencies, 50)),
+        'p99_ms': milliseconds(percentile(latencies, 99)),
+        'throughput_rps': round(requests / elapsed, 1),
+        'queries_per_request': round(
+            float(queries.count - queries_before) / max(requests, 1), 2),
+        'peak_rss_growth_kb': peak_rss_kb() - peak_before,
+    }
+
+
+def serve(app):
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_port
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=ROOT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(scale='small', requests=200, threads=8, mode='both', database=None,
+        output=None):
+    items = SCALES[scale] if scale in SCALES else int(scale)
+    categories = max(10, items // 1000)
+    random.seed(0)
+
+    os.chdir(ROOT)
+    with open('client_secrets.json') as f:
+        client_id = json.load(f)['web']['client_id']
+    provider_server, settings = providers.serve(client_id)
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.abspath(database or os.path.join(directory,
+                                                        'bench.db'))
+        settings['DATABASE_URL'] = 'sqlite:///' + path
+        settings['SESSION_FILE'] = os.path.join(directory, 'sessions.db')
+        settings['SECRET_KEY'] = 'benchmark'
+        settings['OPERATORS'] = OWNER_EMAIL
+        # every request comes from this one address, as fast as it can
+        settings['RATE_LIMIT_BACKEND'] = 'none'
+        # for /metrics, so every route is timed with the instrumentation (see
+        # metrics.py) switched on
+        settings['METRICS_ENABLED'] = '1'
+        for name, value in settings.items():
+            os.environ['CATALOG_' + name] = value
+
+        from database_setup import get_engine
+        import config
+        engine = get_engine(config.settings(DATABASE_URL='sqlite:///' + path))
+        if not os.path.exists(path):
+            sys.stderr.write('seeding %d items in %d categories...\n' % (
+                items, categories))
+            seed(engine, items, categories)
+
+        import catalog
+        app = catalog.create_app(migrate=True)
+        queries = QueryCounter(catalog.engine, catalog.read_engine)
+        upload = sorted(f for f in os.listdir(catalog.UPLOAD_FOLDER)
+                        if os.path.isfile(os.path.join(catalog.UPLOAD_FOLDER,
+                                                       f)))[0]
+
+        modes = ['client', 'server'] if mode == 'both' else [mode]
+        results = []
+        for mode in modes:
+            if mode == 'client':
+                server = None
+                new_client = lambda: TestClient(app)
+                mode_threads = 1
+            else:
+                server, base = serve(app)
+                new_client = lambda: HttpClient(base)
+                mode_threads = threads
+            targets = make_targets(engine, requests)
+            state = Run(new_client, items, categories, targets, upload)
+            for name, setup in ROUTES:
+                result = measure(state, name, setup, requests, mode_threads,
+                                 queries)
+                result['mode'] = mode
+                results.append(result)
+                sys.stderr.write(
+                    '%-7s %-28s %9s %9s %9.1f %7.2f %5d %7d\n' % (
+                        mode, name, result['p50_ms'], result['p99_ms'],
+                        result['throughput_rps'],
+                        result['queries_per_request'], result['errors'],
+                        result['peak_rss_growth_kb']))
+            if server is not None:
+                server.shutdown()
+        engine.dispose()
+    finally:
+        provider_server.shutdown()
+        shutil.rmtree(directory)
+
+    report = {
+        'revision': revision(),
+        'python': sys.version.split()[0],
+        'scale': scale,
+        'items': items,
+        'categories': categories,
+        'users': USERS,
+        'requests': requests,
+        'threads': threads,
+        'results': results,
+    }
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return report
+
+
+def compare(old, new):
+    # print the change in latency and throughput of each route
+    with open(old) as f:
+        before = dict(((r['mode'], r['route']), r)
+                      for r in json.load(f)['results'])
+    with open(new) as f:
+        after = json.load(f)['results']
+
+    def change(key, a, b):
+        if not a.get(key) or b.get(key) is None:
+            return '%10s' % '-'
+        return '%+9.1f%%' % ((b[key] - a[key]) * 100.0 / a[key])
+
+    print('%-7s %-28s %10s %10s %10s %10s' % (
+        'mode', 'route', 'p50', 'p99', 'rps', 'queries'))
+    for result in after:
+        key = (result['mode'], result['route'])
+        if key not in before:
+            continue
+        print('%-7s %-28s %s %s %s %s' % (
+            key[0], key[1],
+            change('p50_ms', before[key], result),
+            change('p99_ms', before[key], result),
+            change('throughput_rps', before[key], result),
+            change('queries_per_request', before[key], result)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark every route.')
+    commands = parser.add_subparsers(dest='command')
+    run_parser = commands.add_parser('run')
+    run_parser.add_argument('--scale', default='small',
+                            help='small, medium, large or a number of items')
+    run_parser.add_argument('--requests', type=int, default=200)
+    run_parser.add_argument('--threads', type=int, default=8)
+    run_parser.add_argument('--mode', choices=['client', 'server', 'both'],
+                            default='both')
+    run_parser.add_argument('--database')
+    run_parser.add_argument('--output')
+    compare_parser = commands.add_parser('compare')
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        compare(args.old, args.new)
+    else:
+        run(args.scale, args.requests, args.threads, args.mode,
+            args.database, args.output)
+
+
+if __name__ == '__main__':
+    main()
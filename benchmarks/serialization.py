@@ -0,0 +1,182 @@
+# Compare the ways of turning a category's items into JSON: loading Item
+# objects and encoding Item.serialize with the standard library (as the JSON
+# endpoints used to), reading the columns as plain rows and encoding them
+# with encoding.dumps, and reading the snapshot already encoded.  A
+# throwaway sqlite database holds one category of the given number of items.
+#
+# For each way the CPU time per run is shown, and its memory: the peak
+# allocated during a run, traced with tracemalloc, or where that isn't
+# available (Python 2) how far one run takes the peak resident memory of a
+# fresh process that has done nothing else above what it started with.
+#
+# usage: python benchmarks/serialization.py [items] [runs]
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+from sqlalchemy.orm import sessionmaker
+from database_setup import Category, Item, ItemSnapshot, get_engine
+from migrations import upgrade
+import config
+import encoding
+import snapshot
+
+
+def seed(engine, items):
+    upgrade(engine)
+    with engine.begin() as connection:
+        connection.execute(Category.__table__.insert(),
+                           {'name': 'category', 'description': 'category'})
+        connection.execute(Item.__table__.insert(), [
+            {'name': 'item %d' % n,
+             'description': 'description of item %d' % n,
+             'price': '9.99', 'image': 'images/%d.jpg' % n,
+             'category_id': 1, 'user_id': 1}
+            for n in range(items)])
+        snapshot.rebuild(connection)
+
+
+def orm_objects(session):
+    items = session.query(Item).filter_by(category_id=1).order_by(Item.id)
+    return json.dumps({'items': [i.serialize for i in items]})
+
+
+def column_rows(session):
+    rows = snapshot.item_rows(session).filter(Item.category_id == 1).\
+        order_by(Item.id)
+    return encoding.dumps({'items': [snapshot.serialize(r) for r in rows]})
+
+
+def snapshot_json(session):
+    rows = session.query(ItemSnapshot.item_json).filter_by(category_id=1).\
+        order_by(ItemSnapshot.item_id)
+    return '{"items": [%s]}' % ', '.join(row.item_json for row in rows)
+
+
+WAYS = [('orm objects', orm_objects),
+        ('column rows', column_rows),
+        ('snapshot', snapshot_json)]
+
+
+def cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss():
+    # the peak resident memory of this process in KiB - ru_maxrss is in
+    # kilobytes on Linux but bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024.0 if sys.platform == 'darwin' else float(peak)
+
+
+def memory_status(field):
+    # VmRSS (resident now) or VmHWM (peak) in KiB, from Linux's /proc
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return float(line.split()[1])
+
+
+def reset_peak():
+    # start the peak resident memory afresh from what is resident now, where
+    # the system allows it (Linux 4.0 on)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def rss_growth(path, name):
+    # run one way once in a fresh process (see measure_rss), so the peak
+    # isn't one left behind by an earlier run
+    output = subprocess.check_output([sys.executable,
+                                      os.path.abspath(__file__), '--rss',
+                                      path, name])
+    return float(output.decode('ascii'))
+
+
+def measure_rss(path, name):
+    engine = get_engine(config.settings(DATABASE_URL='sqlite:///' + path))
+    session = sessionmaker(bind=engine)()
+    # set up the mappers and the connection before taking the baseline
+    session.query(Item).first()
+    session.query(ItemSnapshot).first()
+    if reset_peak():
+        before = memory_status('VmRSS')
+        dict(WAYS)[name](session)
+        after = memory_status('VmHWM')
+    else:
+        # elsewhere the peak may still be one reached while starting up,
+        # which hides a run that stays below it
+        before = peak_rss()
+        dict(WAYS)[name](session)
+        after = peak_rss()
+    print(after - before)
+
+
+def measure(session, function, runs):
+    # mean CPU milliseconds and peak allocated KiB per run, or None without
+    # tracemalloc
+    peak = None if tracemalloc is None else 0
+    started = cpu()
+    for n in range(runs):
+        if tracemalloc is not None:
+            tracemalloc.start()
+        function(session)
+        if tracemalloc is not None:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        session.expunge_all()
+    # tracing slows the runs down, so time them again without it
+    if tracemalloc is not None:
+        started = cpu()
+        for n in range(runs):
+            function(session)
+            session.expunge_all()
+    return (cpu() - started) * 1000 / runs, peak and peak / 1024.0
+
+
+def main(items=10000, runs=20):
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'bench.db')
+        engine = get_engine(config.settings(DATABASE_URL='sqlite:///' + path))
+        seed(engine, items)
+        session = sessionmaker(bind=engine)()
+        encoder = ('orjson' if encoding.orjson else
+                   'ujson' if encoding.ujson else 'json')
+        print('%d items, encoder %s' % (items, encoder))
+        print('%-16s %10s %18s' % ('path', 'cpu (ms)',
+                                   'peak (KiB)' if tracemalloc else
+                                   'rss growth (KiB)'))
+        for name, function in WAYS:
+            ms, kib = measure(session, function, runs)
+            if kib is None:
+                kib = rss_growth(path, name)
+            print('%-16s %10.2f %18.0f' % (name, ms, kib))
+        session.close()
+        engine.dispose()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--rss']:
+        measure_rss(*sys.argv[2:])
+    else:
+        main(*[int(arg) for arg in sys.argv[1:]])
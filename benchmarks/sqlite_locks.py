@@ -0,0 +1,217 @@
+# Run readers and writers against one sqlite file at once, with the sqlite
+# settings in config.py, and count the writes and reads that failed because
+# the database was locked.  A throwaway database is seeded as in routes.py.
+#
+# Each writer keeps changing a random item and refreshing its snapshot (see
+# snapshot.py) in one transaction, as editItem does, through an engine made
+# by get_engine.  Each reader keeps reading the whole catalog snapshot, as
+# /catalog/json does, and a category's items, through the read engine (see
+# get_read_engine) when READ_ROUTING is on.  The same run is then repeated
+# with the rollback journal (SQLITE_JOURNAL_MODE=DELETE) for comparison.
+#
+# Then, for each journal mode, the run is repeated with READER_COUNTS readers
+# alongside the same writers, to show how the reads and writes done per
+# second scale with the number of threads.
+#
+# Any error other than a lock stops the run.
+#
+# usage: python benchmarks/sqlite_locks.py [seconds] [writers] [readers]
+#            [items]
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+
+from routes import seed, percentile
+
+JOURNAL_MODES = ('WAL', 'DELETE')
+READER_COUNTS = (1, 2, 4, 8)
+
+
+class Results(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {'write': [], 'read': []}
+        self.locked = {'write': 0, 'read': 0}
+        self.failures = []
+
+    def add(self, kind, started):
+        with self.lock:
+            self.latencies[kind].append(time.time() - started)
+
+    def add_locked(self, kind):
+        with self.lock:
+            self.locked[kind] += 1
+
+
+def is_locked(error):
+    # "database is locked", or "database table is locked"
+    return 'locked' in str(error.orig)
+
+
+def timed(kind, results, deadline, function):
+    # call function until the deadline, timing each call and counting those
+    # that found the database locked
+    try:
+        while time.time() < deadline:
+            started = time.time()
+            try:
+                function()
+            except OperationalError as e:
+                if not is_locked(e):
+                    raise
+                results.add_locked(kind)
+                continue
+            results.add(kind, started)
+    except Exception:
+        with results.lock:
+            results.failures.append(sys.exc_info())
+
+
+def writer(engine, items, results, deadline):
+    from database_setup import Item
+    import snapshot
+
+    def write():
+        item_id = random.randint(1, items)
+        with engine.begin() as connection:
+            connection.execute(
+                Item.__table__.update().where(Item.__table__.c.id == item_id).
+                values(price='%d.%02d' % (random.randint(0, 99),
+                                          random.randint(0, 99))))
+            snapshot.refresh_items(connection, [item_id])
+
+    timed('write', results, deadline, write)
+
+
+def reader(engine, categories, results, deadline):
+    from database_setup import CatalogSnapshot, ItemSnapshot
+    snapshots = CatalogSnapshot.__table__
+    item_snapshots = ItemSnapshot.__table__
+    n = [0]
+
+    def read():
+        n[0] += 1
+        with engine.begin() as connection:
+            if n[0] % 2:
+                query = select([snapshots.c.category_json,
+                                item_snapshots.c.item_json]).select_from(
+                    snapshots.outerjoin(item_snapshots, snapshots.c.category_id
+                                        == item_snapshots.c.category_id))
+            else:
+                query = select([item_snapshots.c.item_json]).where(
+                    item_snapshots.c.category_id ==
+                    random.randint(1, categories))
+            for row in connection.execute(query):
+                pass
+
+    timed('read', results, deadline, read)
+
+
+def run(path, journal_mode, seconds, writers, readers, items, categories):
+    # the results, and a line describing the sqlite settings used
+    from database_setup import get_engine, get_read_engine
+    import config
+
+    settings = config.settings(DATABASE_URL='sqlite:///' + path,
+                               SQLITE_JOURNAL_MODE=journal_mode)
+    engine = get_engine(settings)
+    read_engine = get_read_engine(settings) or engine
+    # open a connection, so the journal mode is set before anything runs
+    engine.connect().close()
+
+    results = Results()
+    deadline = time.time() + seconds
+    threads = [threading.Thread(target=writer, args=(
+        engine, items, results, deadline)) for w in range(writers)]
+    threads += [threading.Thread(target=reader, args=(
+        read_engine, categories, results, deadline)) for r in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+    read_engine.dispose()
+    if results.failures:
+        raise results.failures[0][1]
+    return results, (
+        'journal_mode=%s synchronous=%s busy_timeout=%dms read routing %s' % (
+            journal_mode, settings['SQLITE_SYNCHRONOUS'],
+            settings['SQLITE_BUSY_TIMEOUT'],
+            'on' if read_engine is not engine else 'off'))
+
+
+def report(results, seconds):
+    print('%-6s %8s %8s %10s %10s %10s %10s' % (
+        '', 'done', 'locked', 'per second', 'p50 (ms)', 'p99 (ms)',
+        'max (ms)'))
+    for kind in ('write', 'read'):
+        latencies = results.latencies[kind]
+        times = tuple('-' if value is None else '%.2f' % (value * 1000)
+                      for value in (percentile(latencies, 50),
+                                    percentile(latencies, 99),
+                                    max(latencies) if latencies else None))
+        print('%-6s %8d %8d %10.1f %10s %10s %10s' % (
+            (kind, len(latencies), results.locked[kind],
+             len(latencies) / float(seconds)) + times))
+
+
+def main(seconds=10, writers=4, readers=8, items=10000):
+    categories = max(10, items // 1000)
+    random.seed(0)
+    directory = tempfile.mkdtemp()
+    try:
+        from database_setup import get_engine
+        import config
+
+        seeded = os.path.join(directory, 'seeded.db')
+        engine = get_engine(config.settings(DATABASE_URL='sqlite:///' +
+                                            seeded,
+                                            SQLITE_JOURNAL_MODE='DELETE'))
+        seed(engine, items, categories)
+        engine.dispose()
+
+        def fresh_run(journal_mode, readers):
+            # each run starts from the same seeded file
+            path = os.path.join(directory, journal_mode + '.db')
+            shutil.copy(seeded, path)
+            return run(path, journal_mode, seconds, writers, readers, items,
+                       categories)
+
+        print('%d writers, %d readers, %ds, %d items in %d categories' % (
+            writers, readers, seconds, items, categories))
+        for journal_mode in JOURNAL_MODES:
+            results, description = fresh_run(journal_mode, readers)
+            print('')
+            print(description)
+            report(results, seconds)
+
+        for journal_mode in JOURNAL_MODES:
+            print('')
+            print('%s, %d writers - per second by number of readers' % (
+                journal_mode, writers))
+            print('%7s %10s %10s %10s %10s' % (
+                'readers', 'reads', 'writes', 'total', 'locked'))
+            for count in READER_COUNTS:
+                results, description = fresh_run(journal_mode, count)
+                reads = len(results.latencies['read']) / float(seconds)
+                writes = len(results.latencies['write']) / float(seconds)
+                print('%7d %10.1f %10.1f %10.1f %10.1f' % (
+                    count, reads, writes, reads + writes,
+                    sum(results.locked.values()) / float(seconds)))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,112 @@
+# Compare the throughput of the development server (python catalog.py) with
+# the production server (gunicorn with gunicorn.conf.py and wsgi.py).  Both
+# serve the same throwaway database, seeded as in routes.py, and are sent
+# the same mix of page and JSON requests from a number of threads.
+#
+# usage: python benchmarks/wsgi.py [requests] [threads] [items]
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import requests
+
+from login import run_concurrently
+from routes import seed
+
+# the requests sent, in turn - {category} and {item} are filled in at random
+PATHS = ['/', '/categories/json', '/category/{category}',
+         '/category/{category}/json', '/item/{item}/detail',
+         '/item/{item}/json']
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start(command, base, env):
+    # start a server and wait until it answers
+    process = subprocess.Popen(command, cwd=ROOT, env=env)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        try:
+            requests.get(base + '/', timeout=1)
+            return process
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError('%s did not start' % command[0])
+
+
+def load(base, count, threads, items, categories):
+    # returns requests per second and the number of failed requests
+    local = threading.local()
+    errors = [0]
+
+    def call(n):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        path = PATHS[n % len(PATHS)].format(
+            category=random.randint(1, categories),
+            item=random.randint(1, items))
+        if local.session.get(base + path).status_code >= 400:
+            errors[0] += 1
+
+    elapsed = run_concurrently(call, count, threads)
+    return count / elapsed, errors[0]
+
+
+def main(count=2000, threads=16, items=10000):
+    from database_setup import get_engine
+    import config
+
+    categories = max(10, items // 1000)
+    directory = tempfile.mkdtemp()
+    try:
+        url = 'sqlite:///' + os.path.join(directory, 'bench.db')
+        engine = get_engine(config.settings(DATABASE_URL=url))
+        print('seeding %d items in %d categories...' % (items, categories))
+        seed(engine, items, categories)
+        engine.dispose()
+
+        env = dict(os.environ, CATALOG_DATABASE_URL=url,
+                   CATALOG_SECRET_KEY='benchmark',
+                   CATALOG_SESSION_FILE=os.path.join(directory,
+                                                     'sessions.db'))
+        servers = [
+            ('development', lambda port: [
+                sys.executable, '-c',
+                'import catalog; catalog.create_app().run(port=%d)' % port]),
+            ('gunicorn', lambda port: [
+                'gunicorn', '-c', 'gunicorn.conf.py',
+                '-b', '127.0.0.1:%d' % port, 'wsgi:app']),
+        ]
+        print('%-12s %10s %8s' % ('server', 'requests/s', 'errors'))
+        for name, command in servers:
+            port = free_port()
+            base = 'http://127.0.0.1:%d' % port
+            process = start(command(port), base, env)
+            try:
+                rate, errors = load(base, count, threads, items, categories)
+            finally:
+                process.terminate()
+                process.wait()
+            print('%-12s %10.1f %8d' % (name, rate, errors))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
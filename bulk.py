@@ -0,0 +1,373 @@
+# Bulk import and export of users, categories and items as CSV or JSON lines
+#
+# usage: python bulk.py import items items.jsonl [--batch-size 5000]
+#        python bulk.py export categories categories.csv
+#
+# Records refer to each other by natural key rather than by id - users by
+# email, categories by name, and items by category name and item name - so a
+# file exported from one catalog can be imported into another.  Importing a
+# record whose key already exists updates that row instead of adding another;
+# fields the record leaves out (or leaves empty, in CSV) keep their values.
+# Import users before the categories and items that refer to them, and
+# categories before their items.  A record missing one of its REQUIRED
+# fields, an item whose category doesn't exist, or a record whose user
+# doesn't exist, is skipped, and reported with its line number in the file.
+#
+# Files are read and written one record at a time.  Imports are applied in
+# batches of --batch-size records, each batch in a single transaction using
+# executemany inserts and updates.  The catalog snapshot (see snapshot.py) of
+# the categories an import touches is made again once, when every batch is
+# in.
+# Pages cached by a running catalog may
+# show the old data until they expire (CATALOG_CACHE_TTL).
+import argparse
+import csv
+import io
+import json
+import sys
+import time
+from collections import OrderedDict
+
+from sqlalchemy import select, bindparam, and_
+from database_setup import User, Category, Item, get_engine
+from migrations import upgrade
+import snapshot
+
+PY2 = sys.version_info[0] == 2
+
+# the fields of each kind of record, in file order
+FIELDS = OrderedDict([
+    ('users', ['name', 'email']),
+    ('categories', ['name', 'description', 'icon', 'user']),
+    ('items', ['name', 'description', 'price', 'image', 'category', 'user']),
+])
+
+# the fields a record can't be imported without
+REQUIRED = {
+    'users': ['name', 'email'],
+    'categories': ['name'],
+    'items': ['name', 'category'],
+}
+
+# most values bound in one IN (...) lookup - older sqlite builds allow 999
+LOOKUP_SIZE = 500
+
+users = User.__table__
+categories = Category.__table__
+items = Item.__table__
+
+
+def open_file(path, mode):
+    if path == '-':
+        return sys.stdin if mode == 'r' else sys.stdout
+    if PY2:
+        return open(path, mode + 'b')
+    return io.open(path, mode, newline='', encoding='utf-8')
+
+
+def file_format(path, name):
+    if name:
+        return name
+    return 'csv' if path.endswith('.csv') else 'jsonl'
+
+
+def read_records(handle, format):
+    # the line number and a dictionary for each record - empty CSV fields are
+    # read as missing, and a line that isn't JSON as None
+    if format == 'csv':
+        reader = csv.DictReader(handle)
+        for row in reader:
+            if PY2:
+                row = dict((k, v.decode('utf-8') if v is not None else v)
+                           for k, v in row.items())
+            yield reader.line_num, dict((k, v) for k, v in row.items()
+                                        if v not in ('', None))
+    else:
+        for number, line in enumerate(handle, 1):
+            if line.strip():
+                try:
+                    yield number, json.loads(line)
+                except ValueError:
+                    yield number, None
+
+
+def record_error(kind, record):
+    # why a record can't be imported, or None if it can
+    if not isinstance(record, dict):
+        return 'not a JSON object'
+    missing = [field for field in REQUIRED[kind] if not record.get(field)]
+    if missing:
+        return 'missing %s' % ', '.join(missing)
+    return None
+
+
+class RecordWriter(object):
+
+    def __init__(self, handle, format, fields):
+        self.handle = handle
+        self.format = format
+        self.fields = fields
+        if format == 'csv':
+            self.writer = csv.writer(handle)
+            self.writer.writerow(fields)
+
+    def write(self, values):
+        if self.format == 'csv':
+            if PY2:
+                values = [v.encode('utf-8') if isinstance(v, unicode) else v
+                          for v in values]
+            self.writer.writerow(['' if v is None else v for v in values])
+        else:
+            self.handle.write(json.dumps(OrderedDict(zip(self.fields,
+                                                         values))) + '\n')
+
+
+def batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def lookup(connection, table, columns, keys):
+    # map each key (a tuple of values for columns) that exists in the table
+    # to its id.  The IN lists may match extra rows, which are ignored.
+    keys = list(set(keys))
+    found = {}
+    for start in range(0, len(keys), LOOKUP_SIZE):
+        chunk = keys[start:start + LOOKUP_SIZE]
+        clause = and_(*[table.c[column].in_(set(key[n] for key in chunk))
+                        for n, column in enumerate(columns)])
+        query = select([table.c.id] + [table.c[c] for c in columns]).\
+            where(clause)
+        for row in connection.execute(query):
+            found[tuple(row[1:])] = row[0]
+    return found
+
+
+def upsert(connection, table, columns, rows):
+    # insert the rows whose key isn't in the table yet and update the others,
+    # setting only the columns each row has; if a key appears more than once
+    # in the batch the last row wins
+    keyed = OrderedDict((tuple(row[c] for c in columns), row) for row in rows)
+    existing = lookup(connection, table, columns, keyed.keys())
+
+    inserts = [row for key, row in keyed.items() if key not in existing]
+    # an executemany needs the same columns in every row, so updates are
+    # grouped by the columns they set, and inserts get them all
+    updates = OrderedDict()
+    for key, row in keyed.items():
+        if key in existing:
+            updates.setdefault(tuple(sorted(row)), []).append(
+                dict(row, _id=existing[key]))
+    if inserts:
+        names = set().union(*inserts)
+        connection.execute(table.insert(), [
+            dict((name, row.get(name)) for name in names) for row in inserts])
+    for group in updates.values():
+        connection.execute(
+            table.update().where(table.c.id == bindparam('_id')), group)
+    return len(inserts), sum(len(group) for group in updates.values())
+
+
+def user_ids(connection, records):
+    emails = [(r['user'],) for r in records if r.get('user')]
+    return dict((key[0], id) for key, id in
+                lookup(connection, users, ['email'], emails).items())
+
+
+def record_row(record, owners, fields, **row):
+    # the columns to set for a record - row, the fields the record has, and
+    # its user's id if it names one
+    row.update((field, record[field]) for field in fields if field in record)
+    if 'user' in record:
+        row['user_id'] = owners.get(record['user'])
+    return row
+
+
+def unknown_user(record, owners):
+    return record.get('user') is not None and record['user'] not in owners
+
+
+# Each importer takes a batch of valid records and returns the numbers of
+# rows inserted and updated, (index, reason) for each record it skipped, and
+# the ids of the categories whose snapshot it changed.
+
+def import_users(connection, records):
+    rows = [{'name': r['name'], 'email': r['email']} for r in records]
+    return upsert(connection, users, ['email'], rows), [], []
+
+
+def import_categories(connection, records):
+    owners = user_ids(connection, records)
+    rows, skipped = [], []
+    for n, r in enumerate(records):
+        if unknown_user(r, owners):
+            skipped.append((n, 'no user with email %r' % r['user']))
+        else:
+            rows.append(record_row(r, owners, ['description', 'icon'],
+                                   name=r['name']))
+    counts = upsert(connection, categories, ['name'], rows)
+    touched = lookup(connection, categories, ['name'],
+                     [(r['name'],) for r in rows]).values()
+    return counts, skipped, touched
+
+
+def import_items(connection, records):
+    owners = user_ids(connection, records)
+    names = [(r['category'],) for r in records]
+    category_ids = dict((key[0], id) for key, id in
+                        lookup(connection, categories, ['name'],
+                               names).items())
+    # an item must belong to a category - skip any whose category is unknown
+    rows, skipped = [], []
+    for n, r in enumerate(records):
+        if r['category'] not in category_ids:
+            skipped.append((n, 'no category named %r' % r['category']))
+        elif unknown_user(r, owners):
+            skipped.append((n, 'no user with email %r' % r['user']))
+        else:
+            rows.append(record_row(r, owners,
+                                   ['description', 'price', 'image'],
+                                   name=r['name'],
+                                   category_id=category_ids[r['category']]))
+    counts = upsert(connection, items, ['category_id', 'name'], rows)
+    return counts, skipped, [r['category_id'] for r in rows]
+
+
+IMPORTERS = {
+    'users': import_users,
+    'categories': import_categories,
+    'items': import_items,
+}
+
+
+def export_query(kind):
+    # rows in the same field order as FIELDS[kind]
+    if kind == 'users':
+        return select([users.c.name, users.c.email]).order_by(users.c.id)
+    if kind == 'categories':
+        return select([categories.c.name, categories.c.description,
+                       categories.c.icon, users.c.email]).\
+            select_from(categories.outerjoin(
+                users, categories.c.user_id == users.c.id)).\
+            order_by(categories.c.id)
+    return select([items.c.name, items.c.description, items.c.price,
+                   items.c.image, categories.c.name, users.c.email]).\
+        select_from(items.join(
+            categories, items.c.category_id == categories.c.id).outerjoin(
+            users, items.c.user_id == users.c.id)).\
+        order_by(items.c.id)
+
+
+class Progress(object):
+    # report how far an import or export has got, at most once a second
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.count = 0
+        self.start = self.reported = time.time()
+
+    def add(self, count, force=False):
+        self.count += count
+        now = time.time()
+        if force or now - self.reported >= 1:
+            self.reported = now
+            sys.stderr.write('%s: %d records (%d/s)\n' % (
+                self.kind, self.count,
+                self.count / max(now - self.start, 0.001)))
+
+
+def import_file(engine, kind, path, format=None, batch_size=5000):
+    handle = open_file(path, 'r')
+    progress = Progress(kind)
+    totals = [0, 0, 0]
+    touched = set()
+
+    def skip(number, reason):
+        totals[2] += 1
+        sys.stderr.write('%s: line %d: %s, skipped\n' % (kind, number,
+                                                         reason))
+
+    def valid(records):
+        for number, record in records:
+            error = record_error(kind, record)
+            if error is None:
+                yield number, record
+            else:
+                skip(number, error)
+                progress.add(1)
+
+    try:
+        for batch in batches(valid(read_records(handle,
+                                                file_format(path, format))),
+                             batch_size):
+            numbers = [number for number, record in batch]
+            with engine.begin() as connection:
+                (inserted, updated), skipped, category_ids = \
+                    IMPORTERS[kind](connection,
+                                    [record for number, record in batch])
+            totals[0] += inserted
+            totals[1] += updated
+            for n, reason in skipped:
+                skip(numbers[n], reason)
+            touched.update(category_ids)
+            progress.add(len(batch))
+    finally:
+        if handle is not sys.stdin:
+            handle.close()
+    if touched:
+        with engine.begin() as connection:
+            snapshot.rebuild(connection, touched)
+    progress.add(0, force=True)
+    sys.stderr.write('%s: %d inserted, %d updated, %d skipped\n' % (
+        kind, totals[0], totals[1], totals[2]))
+    return totals
+
+
+def export_file(engine, kind, path, format=None):
+    handle = open_file(path, 'w')
+    writer = RecordWriter(handle, file_format(path, format), FIELDS[kind])
+    progress = Progress(kind)
+    connection = engine.connect()
+    try:
+        result = connection.execution_options(stream_results=True).\
+            execute(export_query(kind))
+        for row in result:
+            writer.write(list(row))
+            progress.add(1)
+    finally:
+        connection.close()
+        if handle is not sys.stdout:
+            handle.close()
+    progress.add(0, force=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Import or export catalog records as CSV or JSON lines.')
+    parser.add_argument('action', choices=['import', 'export'])
+    parser.add_argument('kind', choices=list(FIELDS))
+    parser.add_argument('path', help="file to read or write, or - for "
+                                     "standard input or output")
+    parser.add_argument('--format', choices=['csv', 'jsonl'],
+                        help='file format (default: from the file name)')
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help='records per import transaction')
+    args = parser.parse_args(argv)
+
+    engine = get_engine()
+    upgrade(engine)
+    if args.action == 'import':
+        import_file(engine, args.kind, args.path, args.format,
+                    args.batch_size)
+    else:
+        export_file(engine, args.kind, args.path, args.format)
+
+
+if __name__ == '__main__':
+    main()
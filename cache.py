@@ -0,0 +1,246 @@
+# Response caching for the read-heavy pages and JSON endpoints
+#
+# Rendered responses are kept in a backend - LocalCache, an in-process LRU,
+# or RedisCache, shared by every worker process - for up to CACHE_TTL
+# seconds, keyed by URL and the logged in user (which decides user_status).
+#
+# Every entry is tagged with the rows it was built from, e.g. 'category:3',
+# and every tag has a version token.  The write routes invalidate a tag by
+# giving it a new token; an entry saved under an older token is then treated
+# as a miss, so readers never see a page from before the last write.
+#
+# With LocalCache each worker process has its own tags, and a write only
+# invalidates them in the worker that handled it.  So every entry also keeps
+# the version conditional() read from the database for the request that
+# built it, and is only used while that version is still current - a write
+# made through any worker changes it.
+#
+# Single rows of the long lists are also cached as rendered HTML fragments
+# (see fragment), so a page whose entry is stale can be put together again
+# from the rows that haven't changed.
+#
+# conditional() adds ETag and Last-Modified headers, so browsers and proxies
+# can revalidate a page with a cheap 304 instead of downloading it again.
+import hashlib
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request, g, make_response
+from flask import session as login_session
+from markupsafe import Markup
+
+
+class LocalCache(object):
+    # in-process least recently used cache - a ttl of None uses the default,
+    # a ttl of 0 never expires
+
+    def __init__(self, max_entries=10000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires and expires < time.time():
+                return None
+            # put it back at the end to mark it as the most recently used
+            self.entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl else None
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, expires)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class RedisCache(object):
+    # cache shared between worker processes and servers - needs the redis
+    # package and a redis server, e.g. redis://localhost:6379/0
+
+    def __init__(self, url, ttl=300, prefix='catalog:'):
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        return pickle.loads(value)
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self.client.set(self.prefix + key,
+                        pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                        ex=ttl or None)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+def make_backend(settings):
+    # build the cache backend named by CACHE_BACKEND - 'local', 'redis', or
+    # 'none' to switch caching off
+    backend = settings['CACHE_BACKEND']
+    if backend == 'local':
+        return LocalCache(settings['CACHE_MAX_ENTRIES'], settings['CACHE_TTL'])
+    if backend == 'redis':
+        return RedisCache(settings['CACHE_URL'], settings['CACHE_TTL'])
+    if backend == 'none':
+        return None
+    raise ValueError('unknown cache backend %r' % backend)
+
+
+class ResponseCache(object):
+
+    def __init__(self, backend=None):
+        self.backend = backend
+
+    def version(self, tag):
+        # the current version token of a tag, creating one if it has none
+        key = 'tag:' + tag
+        token = self.backend.get(key)
+        if token is None:
+            token = uuid.uuid4().hex
+            self.backend.set(key, token, 0)
+        return token
+
+    def fragment(self, key, render):
+        # a piece of a page, such as one row of a list, taken from the cache
+        # or made by render() - the key parts must include the version of
+        # everything the piece shows, so a changed row gets a new key
+        if self.backend is None:
+            return render()
+        key = 'fragment:' + ':'.join('%s' % part for part in key)
+        html = self.backend.get(key)
+        if html is None:
+            html = render()
+            self.backend.set(key, html)
+        return Markup(html)
+
+    def invalidate(self, *tags):
+        # called by the write routes after a commit - every cached response
+        # tagged with one of these tags is stale from now on
+        if self.backend is None:
+            return
+        for tag in tags:
+            self.backend.set('tag:' + tag, uuid.uuid4().hex, 0)
+
+    def tag(self, *tags):
+        # tag the response being built by the current view with rows that are
+        # only known once the view has looked them up
+        if 'cache_tags' in g:
+            for tag in tags:
+                g.cache_tags[tag] = self.version(tag)
+
+    def cached(self, *tags):
+        # decorator for a GET view - tags may refer to the view arguments,
+        # e.g. 'category:{category_id}'
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                # pages carrying flashed messages are personal, so skip them
+                if (self.backend is None or request.method != 'GET' or
+                        '_flashes' in login_session):
+                    return f(*args, **kwargs)
+
+                key = 'view:%s:%s' % (request.full_path,
+                                      login_session.get('user_id'))
+                validator = g.get('cache_validator')
+                entry = self.backend.get(key)
+                if entry is not None and \
+                        entry.get('validator') == validator and all(
+                            self.version(tag) == token
+                            for tag, token in entry['tags'].items()):
+                    return current_app.response_class(
+                        entry['body'], entry['status'], entry['headers'])
+
+                # read the tag versions before the view queries the database,
+                # so a write that lands while it runs makes this entry stale
+                g.cache_tags = dict((tag, self.version(tag)) for tag in
+                                    (t.format(**kwargs) for t in tags))
+                response = make_response(f(*args, **kwargs))
+                if response.status_code == 200 and not response.is_streamed:
+                    self.backend.set(key, {
+                        'body': response.get_data(),
+                        'status': response.status_code,
+                        'headers': [(k, v) for k, v in response.headers
+                                    if k.lower() != 'set-cookie'],
+                        'tags': g.cache_tags,
+                        'validator': validator
+                    })
+                return response
+            return wrapper
+        return decorator
+
+
+def conditional(validator):
+    # decorator for a GET view - validator(**view_args) returns a version
+    # string and the last modified time of the rows the page is built from,
+    # or None if they can't be found.  A request whose If-None-Match or
+    # If-Modified-Since header is still current gets a 304 without the view
+    # running at all.
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            versions = validator(**kwargs)
+            if versions is None or '_flashes' in login_session:
+                return f(*args, **kwargs)
+
+            # the page also depends on who is looking at it
+            version, last_modified = versions
+            # checked by ResponseCache.cached against its entries
+            g.cache_validator = version
+            etag = hashlib.sha1(('%s:%s:%s' % (
+                request.full_path, login_session.get('user_id'),
+                version)).encode('utf-8')).hexdigest()
+
+            if request.if_none_match:
+                # weakly, as compressed responses have weak ETags (see
+                # encoding.py)
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                since = request.if_modified_since
+                not_modified = (since is not None and
+                                last_modified is not None and
+                                last_modified.replace(microsecond=0) <=
+                                since.replace(tzinfo=None))
+
+            if not_modified:
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            return response
+        return wrapper
+    return decorator
@@ -1,24 +1,78 @@
 # Import required libraries
 from flask import Flask, render_template, request, url_for, redirect, jsonify
-from flask import make_response, send_file, flash
+from flask import make_response, send_file, flash, Response
+from flask import stream_with_context, after_this_request
 # we're already using the word session for db session
 from flask import session as login_session
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from database_setup import Base, User, Category, Item
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm import make_transient_to_detached
+from database_setup import Base, User, Category, Item, CatalogSnapshot
+from database_setup import ItemSnapshot, SnapshotState
+from database_setup import get_engine, get_read_engine
+from migrations import upgrade
+from cache import ResponseCache, LocalCache, make_backend, conditional
+from sessions import make_session_interface, regenerate
+import images
+import uploads
+import search
+import auth
+import snapshot
+import metrics
+import jobs
+import encoding
+import assets
+import ratelimit
+import routing
+import itertools
 import random
 import string
-from oauth2client.client import flow_from_clientsecrets, FlowExchangeError
+from oauth2client.client import FlowExchangeError
+import errno
 import json
-import httplib2
-import requests
 import os
 import sys
-from werkzeug.utils import secure_filename
-from flask import send_from_directory
+from jinja2 import FileSystemBytecodeCache
 
 
-app = Flask(__name__)
+class CatalogApp(Flask):
+
+    # static files are served the same way as uploads (see
+    # uploaded_file), and kept for a year when linked with their
+    # fingerprint by asset()
+    def send_static_file(self, filename):
+        if 'v' in request.args:
+            max_age = assets.FOREVER
+        else:
+            max_age = self.get_send_file_max_age(filename)
+        return assets.send(self.static_folder, filename,
+                           self.config['STATIC_ACCEL_PREFIX'], max_age)
+
+
+app = CatalogApp(__name__)
+app.config.from_object('config')
+
+# keep compiled templates on disk, so a new worker process only has to load
+# them rather than compile them again
+if app.config['TEMPLATE_CACHE_DIR']:
+    # every worker gets here as it starts, so another may make it first
+    try:
+        os.makedirs(app.config['TEMPLATE_CACHE_DIR'])
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(
+        app.config['TEMPLATE_CACHE_DIR'])
+
+# keep login sessions on the server, with only a session id in the cookie
+# (see sessions.py)
+session_interface = make_session_interface(app.config)
+if session_interface is not None:
+    app.session_interface = session_interface
+
+# work left until after a request has been answered - removing unused
+# uploads, resizing new ones and revoking login tokens (see jobs.py)
+queue = jobs.make_queue(app.config)
 
 
 # image uploads
@@ -26,6 +80,8 @@ app = Flask(__name__)
 UPLOAD_FOLDER = 'images'
 ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif', 'JPG', 'PNG', 'GIF'])
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# uploads are written straight into the upload folder as they arrive
+app.request_class = uploads.UploadRequest
 
 
 def allowed_file(filename):
@@ -34,65 +90,270 @@ def allowed_file(filename):
 
 
 def uploadFile(userfile):
-    # avoid filename crashes - assign a random name and check if it exists
-    if userfile:
-        new_name = ''.join(random.choice(string.ascii_uppercase + string.
-                                         digits)for x in xrange(8))
-
-        userfile.filename = new_name + "." + \
-            userfile.filename.rsplit('.', 1)[1]
-
-        # check that the file name isn't already in use - if it is, assign a
-        # new one
-        while os.path.isfile('images/' + userfile.filename):
-            new_name = ''.join(random.choice(string.ascii_uppercase + string.
-                                             digits)for x in xrange(8))
-            userfile.filename = new_name + "." + \
-                userfile.filename.rsplit('.', 1)[1]
-
-        # now that we have a good filename, do the upload
-        file = userfile
-        if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-
-        return userfile.filename
+    # store the upload under a name made from its content, so identical
+    # images share one file (see uploads.py)
+    if userfile and allowed_file(userfile.filename):
+        with metrics.timer('upload'):
+            filename, new = uploads.save(userfile,
+                                         app.config['UPLOAD_FOLDER'],
+                                         app.config['MAX_UPLOAD_SIZE'])
+        # make the smaller copies shown by the templates in the background,
+        # so the form post returns straight away
+        if new and images.resizable(filename):
+            queue.enqueue('resizeUpload', filename)
+        if not new:
+            # the stored copy may be being removed (see uploads.py) - once
+            # the request has committed its reference, put it back if so
+            @after_this_request
+            def restoreUpload(response):
+                if (uploads.restore(userfile, app.config['UPLOAD_FOLDER'],
+                                    filename) and
+                        images.resizable(filename)):
+                    queue.enqueue('resizeUpload', filename)
+                return response
+        return filename
     else:
         return None
 
 
-# check to see if an uploaded file exists, and if so, delete it
-def deleteFile(filename):
-    if filename:
-        if os.path.isfile(UPLOAD_FOLDER + '/' + filename):
-            os.remove(UPLOAD_FOLDER + '/' + filename)
+@queue.task
+def resizeUpload(filename):
+    images.make_variants(app.config['UPLOAD_FOLDER'], filename)
+
+
+# delete uploaded files and their resized copies once no category or item
+# uses them any more - uploads are shared, so this must be called after the
+# change that dropped the references has been committed.  The files are
+# checked and removed by a background job.
+def deleteFiles(*filenames):
+    filenames = sorted(set(f for f in filenames if f))
+    if filenames:
+        queue.enqueue('removeUploads', filenames)
+
+
+@queue.task
+def removeUploads(filenames):
+    # the app context gives the job a database session of its own, which is
+    # removed again at the end
+    with app.app_context():
+        folder = app.config['UPLOAD_FOLDER']
+        for filename in filenames:
+            # set the file aside first, so an upload of the same content
+            # from now on stores it again (see uploads.py)
+            aside = uploads.set_aside(folder, filename)
+            try:
+                used = (session.query(Category.id).filter_by(icon=filename).
+                        first() or session.query(Item.id).
+                        filter_by(image=filename).first())
+            except Exception:
+                if aside is not None:
+                    uploads.put_back(aside, folder, filename)
+                raise
+            if used:
+                if aside is not None:
+                    uploads.put_back(aside, folder, filename)
+                continue
+            if aside is not None:
+                os.remove(aside)
+            images.delete_variants(folder, filename)
+
+
+# used by the templates to find the resized copy of an upload that fits
+@app.template_global()
+def thumbnail(filename, size, extension=None):
+    return images.thumbnail(app.config['UPLOAD_FOLDER'], filename, size,
+                            extension)
+
+
+# for displaying an uploaded file - uploads are named after their content
+# and never changed, so browsers may keep them for a year without checking
+# again (see assets.py)
+@app.route('/uploads/<path:filename>')
+def uploaded_file(filename):
+    return assets.send(app.config['UPLOAD_FOLDER'], filename,
+                       app.config['UPLOADS_ACCEL_PREFIX'], assets.FOREVER)
 
 
-# for displaying an uploaded file
-@app.route('/uploads/<filename>')
-def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'],
-                               filename)
+# used by the templates to link to a static file, with a fingerprint of its
+# content so that browsers fetch it again when it changes
+@app.template_global()
+def asset(filename):
+    return url_for('static', filename=filename,
+                   v=assets.fingerprint(app.static_folder, filename))
 
 
-# Set up a connection to the database
-engine = create_engine('sqlite:///catalog.db')
+# Set up a pool of connections to the configured database (see config.py)
+engine = get_engine(app.config)
 Base.metadata.bind = engine
 
-DBSession = sessionmaker(bind=engine)
-session = DBSession()
+# GET requests read from their own read-only engine, if there is one, so
+# long reads don't hold up the writes (see routing.py)
+read_engine = get_read_engine(app.config)
+
+# each request gets its own session from the scoped session registry, so a
+# failed commit in one request can't affect any other
+DBSession = sessionmaker(bind=engine, class_=routing.RoutingSession,
+                         reader=read_engine,
+                         read_your_writes=app.config['READ_YOUR_WRITES'])
+session = scoped_session(DBSession)
+
+
+# roll back anything left uncommitted and return the connection to the pool
+# once the request is finished
+@app.teardown_appcontext
+def shutdown_session(exception=None):
+    session.remove()
+
+
+# time the SQL, templates and uploads of each request, if switched on in
+# config.py (see metrics.py)
+metrics.init_app(app, engine, read_engine)
+
+
+# cache for rendered pages and JSON - the write routes invalidate the tags of
+# the rows they change (see cache.py)
+cache = ResponseCache(make_backend(app.config))
+
+
+# rate limits for the write routes and logins, with writes let through a few
+# at a time (see ratelimit.py)
+limiter = ratelimit.Limiter(ratelimit.make_buckets(app.config), app.config)
+
+
+# used by the templates to cache the markup of a single list row - used as
+#   {% call fragment('item-row', i.id, i.updated_at) %}...{% endcall %}
+# with the row's id and everything that changes when it does.  Rows showing
+# an upload switch to its resized copies (see images.py) when the fragment
+# expires.
+@app.template_global()
+def fragment(*key, **kwargs):
+    return cache.fragment(key, kwargs['caller'])
+
+
+# validators for conditional GETs (see cache.conditional) - each returns a
+# version for the rows a page is built from, and when they last changed.
+# Both have to move on when a row is deleted too, which the times of the rows
+# left don't show: a category's snapshot row (see snapshot.py) changes
+# whenever an item goes into or out of it, and the pages listing every
+# category also go by when one was last deleted.
+def latest(*times):
+    times = [t for t in times if t is not None]
+    return max(times) if times else None
+
+
+def categoryDeletedAt():
+    # as a subquery, so it is read along with the other columns
+    return session.query(SnapshotState.category_deleted_at).\
+        filter(SnapshotState.id == 1).as_scalar()
+
+
+def categoriesVersion():
+    count, updated, deleted = session.query(
+        func.count(Category.id), func.max(Category.updated_at),
+        categoryDeletedAt()).one()
+    return '%d:%s' % (count, updated), latest(updated, deleted)
+
+
+def categoryVersion(category_id):
+    row = session.query(CatalogSnapshot.updated_at,
+                        CatalogSnapshot.item_count).\
+        filter(CatalogSnapshot.category_id == category_id).first()
+    if row is None:
+        return None
+    return '%s:%d' % row, row[0]
+
+
+def itemVersion(item_id):
+    row = session.query(Item.updated_at, Category.updated_at).\
+        join(Category, Item.category_id == Category.id).\
+        filter(Item.id == item_id).first()
+    if row is None:
+        return None
+    return '%s:%s' % row, latest(*row)
+
+
+# the home page also shows each category's item count, which changes with
+# the items - the snapshot rows change whenever a category or its items do
+def countsVersion():
+    count, updated, deleted = session.query(
+        func.count(CatalogSnapshot.category_id),
+        func.max(CatalogSnapshot.updated_at), categoryDeletedAt()).one()
+    return '%d:%s' % (count, updated), latest(updated, deleted)
+
+
+# the whole catalog is built from the same snapshot rows
+catalogVersion = countsVersion
+
+
+# the ?after= and ?limit= arguments of a paginated list page
+def pageArgs():
+    after = request.args.get('after', 0, type=int)
+    limit = request.args.get('limit', app.config['PAGE_SIZE'], type=int)
+    return after, max(1, min(limit, app.config['MAX_PAGE_SIZE']))
+
+
+# keyset pagination for list pages - ?after=<id>&limit=N returns up to N rows
+# with an id (key column) greater than after, so every page costs the same
+# query however far into a list it is.  Returns the rows and a link to the
+# next page, or None if this is the last one.
+def paginate(query, key):
+    after, limit = pageArgs()
+
+    # fetch one row more than asked for to find out if there's another page
+    rows = query.filter(key > after).order_by(key).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    args = dict(request.view_args, after=getattr(rows[-1], key.key),
+                limit=limit)
+    return rows, url_for(request.endpoint, **args)
+
+
+# bring the catalog snapshot of the categories and items changed by this
+# request up to date (see snapshot.py) - called just before the commit, so
+# the snapshot changes in the same transaction
+def refreshSnapshot(categories=(), items=()):
+    session.flush()
+    snapshot.refresh_categories(session.connection(), categories)
+    snapshot.refresh_items(session.connection(), items)
+
+
+# response for JSON that has already been encoded
+def jsonResponse(body):
+    return Response(body, mimetype='application/json')
+
+
+# JSON endpoints with ?format=ndjson stream one JSON value per line instead
+# of a single document
+def wantsNDJSON():
+    return request.args.get('format') == 'ndjson'
+
+
+def ndjsonResponse(lines):
+    return Response(stream_with_context(line + '\n' for line in lines),
+                    mimetype='application/x-ndjson')
+
+
+# compress the JSON responses for clients that accept it (see encoding.py)
+@app.after_request
+def compressResponse(response):
+    return encoding.compress(request, response, app.config)
 
 
 # Show the main page
 @app.route('/')
+@conditional(countsVersion)
+@cache.cached('categories', 'counts')
 def home():
-    categories = session.query(Category)
+    categories, next_url = paginate(session.query(Category), Category.id)
     return render_template('home.html', categories=categories,
-                           user_status=userStatus())
+                           next_url=next_url, user_status=userStatus())
 
 
 # route and method for creating a new category
 @app.route('/category/new', methods=['GET', 'POST'])
+@limiter.limit('write')
 def addCategory():
     # only logged in users can add a category - so check login status first
     if 'user_id' not in login_session:
@@ -107,7 +368,10 @@ def addCategory():
                                form['description'], icon=filename,
                                user_id=login_session['user_id'])
         session.add(newCategory)
+        session.flush()
+        refreshSnapshot(categories=[newCategory.id])
         session.commit()
+        cache.invalidate('categories')
         flash("New Category %s has been created!" % newCategory.name)
         return redirect(url_for('home'))
     else:
@@ -116,15 +380,20 @@ def addCategory():
 
 # route and method for listing all items by category
 @app.route('/category/<int:category_id>')
+@conditional(categoryVersion)
+@cache.cached('category:{category_id}')
 def itemsByCategory(category_id):
     category = session.query(Category).filter_by(id=category_id).one()
-    items = session.query(Item).filter_by(category_id=category_id)
+    items, next_url = paginate(
+        session.query(Item).filter_by(category_id=category_id), Item.id)
     return render_template('category.html', category=category, items=items,
+                           next_url=next_url,
                            user_status=userStatus(category.user_id))
 
 
 # route and method for editing an existing category
 @app.route('/category/<int:category_id>/edit', methods=['GET', 'POST'])
+@limiter.limit('write')
 def editCategory(category_id):
     # retrieve the category record from the database
     category = session.query(Category).filter_by(id=category_id).one()
@@ -142,11 +411,16 @@ def editCategory(category_id):
     # record
     if request.method == 'POST':
         filename = uploadFile(request.files['userfilename'])
+        old_icon = category.icon
         category.name = request.form['name']
         category.description = request.form['description']
         category.icon = filename
         session.add(category)
+        refreshSnapshot(categories=[category_id])
         session.commit()
+        cache.invalidate('categories', 'category:%d' % category_id)
+        if old_icon != filename:
+            deleteFiles(old_icon)
         flash("Category %s has been edited!" % category.name)
         return redirect(url_for('itemsByCategory', category_id=category_id))
     else:
@@ -155,6 +429,7 @@ def editCategory(category_id):
 
 # route and method for deleting a category
 @app.route('/category/<int:category_id>/delete', methods=['GET', 'POST'])
+@limiter.limit('write')
 def deleteCategory(category_id):
     # retrieve the category record from the database
     category = session.query(Category).filter_by(id=category_id).one()
@@ -166,19 +441,20 @@ def deleteCategory(category_id):
         flash('You must be logged in as author of this category to edit it.')
         return redirect(url_for('itemsByCategory', category_id=category_id))
 
-    # delete the associated image from the server and then
-    # delete the selected record from the database
+    # delete the selected record from the database and then delete the
+    # associated image from the server
     if request.method == 'POST':
-        deleteFile(category.icon)
-
         # child items records will be deleted by cascade, but delete their
         # associated image files as well
         items = session.query(Item).filter_by(category_id=category_id).all()
-        for i in items:
-            deleteFile(i.image)
+        filenames = set([category.icon] + [i.image for i in items])
 
         session.delete(category)
+        refreshSnapshot(categories=[category_id])
         session.commit()
+        cache.invalidate('categories', 'category:%d' % category_id,
+                         *['item:%d' % i.id for i in items])
+        deleteFiles(*filenames)
         flash("The category has been deleted.")
         return redirect(url_for('home'))
     else:
@@ -187,6 +463,7 @@ def deleteCategory(category_id):
 
 # route and method for creating a new item
 @app.route('/item/new/<int:category_id>', methods=['GET', 'POST'])
+@limiter.limit('write')
 def addItem(category_id):
     # users must be logged in to create a new item
     if 'user_id' not in login_session:
@@ -207,7 +484,10 @@ def addItem(category_id):
                        category_id=request.form['category'],
                        user_id=login_session['user_id'])
         session.add(newItem)
+        session.flush()
+        refreshSnapshot(items=[newItem.id])
         session.commit()
+        cache.invalidate('counts', 'category:%d' % newItem.category_id)
         flash("Item %s has been created!" % newItem.name)
         return redirect(url_for('itemsByCategory',
                         category_id=newItem.category_id))
@@ -218,8 +498,12 @@ def addItem(category_id):
 
 # route and method for displaying item detail
 @app.route('/item/<int:item_id>/detail')
+@conditional(itemVersion)
+@cache.cached('item:{item_id}')
 def itemDetail(item_id):
     item = session.query(Item).filter_by(id=item_id).one()
+    # the page also shows the category name
+    cache.tag('category:%d' % item.category_id)
     category = session.query(Category).filter_by(id=item.category_id).one()
     return render_template('itemdetail.html', item=item, category=category,
                            user_status=userStatus(item.user_id))
@@ -227,6 +511,7 @@ def itemDetail(item_id):
 
 # route and method for editing an existing item
 @app.route('/item/<int:item_id>/edit', methods=['GET', 'POST'])
+@limiter.limit('write')
 def editItem(item_id):
     # get the item record to be edited from the database
     item = session.query(Item).filter_by(id=item_id).one()
@@ -243,13 +528,21 @@ def editItem(item_id):
     # get the edited information from the form and update the database record
     if request.method == 'POST':
         filename = uploadFile(request.files['userfilename'])
+        old_category_id = item.category_id
+        old_image = item.image
         item.name = request.form['name']
         item.description = request.form['description']
         item.price = request.form['price']
         item.image = filename
         item.category_id = request.form['category']
         session.add(item)
+        refreshSnapshot(items=[item_id])
         session.commit()
+        cache.invalidate('counts', 'item:%d' % item_id,
+                         'category:%d' % old_category_id,
+                         'category:%d' % item.category_id)
+        if old_image != filename:
+            deleteFiles(old_image)
         flash("Item %s has been edited." % item.name)
         return redirect(url_for('itemDetail', item_id=item.id))
     else:
@@ -260,6 +553,7 @@ def editItem(item_id):
 
 # route and method for deleting an item
 @app.route('/item/<int:item_id>/delete', methods=['GET', 'POST'])
+@limiter.limit('write')
 def deleteItem(item_id):
     # get the record to be deleted from the database
     item = session.query(Item).filter_by(id=item_id).one()
@@ -273,12 +567,15 @@ def deleteItem(item_id):
         flash('Only the creator of an item may delete it.')
         return redirect(url_for('itemDetail', item_id=item_id))
 
-    # delete the associated image from the server and
-    # delete the record from the database
+    # delete the record from the database and
+    # delete the associated image from the server
     if request.method == 'POST':
-        deleteFile(item.image)
         session.delete(item)
+        refreshSnapshot(items=[item_id])
         session.commit()
+        cache.invalidate('counts', 'item:%d' % item_id,
+                         'category:%d' % item.category_id)
+        deleteFiles(item.image)
         flash("Item has been deleted.")
         return redirect(url_for('itemsByCategory',
                                 category_id=item.category_id))
@@ -286,6 +583,170 @@ def deleteItem(item_id):
         return render_template('deleteitem.html', item=item)
 
 
+# JSON endpoint for changing many items at once - the body is
+#   {"operations": [{"op": "create", "name": ..., "description": ...,
+#                    "price": ..., "category": <category id>},
+#                   {"op": "update", "id": <item id>, "name": ..., ...},
+#                   {"op": "move", "id": <item id>, "category": <id>},
+#                   {"op": "delete", "id": <item id>}, ...]}
+# Operations are applied in order, all in one transaction, and the reply
+# has a result for each: its status, the item id, or the reason it was
+# skipped.  A skipped operation doesn't stop the others.  As with the forms,
+# only the creator of an item may change it - the items are all checked with
+# one query - and images aren't changed here.  A malformed operation (see
+# batchOperationError) fails the whole batch with a 400 saying which one it
+# was, before anything is changed.
+BATCH_FIELDS = ('name', 'description', 'price')
+
+
+def batchOperationError(op):
+    # what is wrong with an operation of a batch, or None if it is well formed
+    if not isinstance(op, dict):
+        return 'expected an object'
+    for key in ('id', 'category'):
+        # JSON true and false are bools, which are also ints
+        if key in op and (isinstance(op[key], bool) or
+                          not isinstance(op[key], int)):
+            return '%s must be a number' % key
+    for field in BATCH_FIELDS:
+        value = op.get(field)
+        if value is None:
+            if field == 'name' and 'name' in op:
+                return 'name must not be null'
+            continue
+        # JSON strings are always unicode
+        if not isinstance(value, type(u'')):
+            return '%s must be a string or null' % field
+        length = Item.__table__.c[field].type.length
+        if len(value) > length:
+            return '%s is longer than %d characters' % (field, length)
+    return None
+
+
+@app.route('/items/batch', methods=['POST'])
+@limiter.limit('write')
+def itemsBatch():
+    if 'user_id' not in login_session:
+        response = jsonify(error='You must be logged in to change items')
+        response.status_code = 401
+        return response
+    body = request.get_json(silent=True)
+    operations = body.get('operations') if isinstance(body, dict) else None
+    if not isinstance(operations, list):
+        response = jsonify(error='expected {"operations": [...]}')
+        response.status_code = 400
+        return response
+    if len(operations) > app.config['BATCH_MAX_OPERATIONS']:
+        response = jsonify(error='at most %d operations per batch' %
+                           app.config['BATCH_MAX_OPERATIONS'])
+        response.status_code = 400
+        return response
+    for index, op in enumerate(operations):
+        error = batchOperationError(op)
+        if error is not None:
+            response = jsonify(error='operation %d: %s' % (index, error),
+                               operation=index)
+            response.status_code = 400
+            return response
+
+    # load every item and category the batch refers to, a chunk of ids at a
+    # time (see snapshot.chunks)
+    item_ids = set(op.get('id') for op in operations if op.get('id'))
+    items = {}
+    for ids in snapshot.chunks(item_ids):
+        items.update((i.id, i) for i in session.query(Item).filter(
+            Item.id.in_(ids)))
+    category_ids = set(op.get('category') for op in operations
+                       if op.get('category'))
+    categories = set()
+    for ids in snapshot.chunks(category_ids):
+        categories.update(row[0] for row in session.query(Category.id).
+                          filter(Category.id.in_(ids)))
+
+    results = []
+    created = []
+    touched = set()
+    deleted_images = []
+    for op in operations:
+        kind = op.get('op')
+        item = items.get(op.get('id'))
+        category_id = op.get('category')
+        if kind not in ('create', 'update', 'move', 'delete'):
+            results.append({'status': 'error',
+                            'error': 'unknown operation %r' % kind})
+            continue
+        if kind != 'create' and item is None:
+            results.append({'status': 'error', 'id': op.get('id'),
+                            'error': 'no such item'})
+            continue
+        if kind != 'create' and item.user_id != login_session['user_id']:
+            results.append({'status': 'error', 'id': item.id,
+                            'error': 'only the creator may change an item'})
+            continue
+        if (kind == 'create' or kind == 'move' or category_id) and \
+                category_id not in categories:
+            results.append({'status': 'error', 'id': op.get('id'),
+                            'error': 'no such category'})
+            continue
+
+        if kind == 'create':
+            if not op.get('name'):
+                results.append({'status': 'error',
+                                'error': 'a new item needs a name'})
+                continue
+            item = Item(user_id=login_session['user_id'],
+                        category_id=category_id,
+                        **dict((f, op.get(f)) for f in BATCH_FIELDS))
+            session.add(item)
+            result = {'status': 'created'}
+            created.append((item, result))
+        elif kind == 'delete':
+            touched.add(item.category_id)
+            deleted_images.append(item.image)
+            session.delete(item)
+            del items[item.id]
+            result = {'status': 'deleted', 'id': item.id}
+        else:
+            touched.add(item.category_id)
+            if kind == 'update':
+                for field in BATCH_FIELDS:
+                    if field in op:
+                        setattr(item, field, op[field])
+            if category_id:
+                item.category_id = category_id
+            result = {'status': 'moved' if kind == 'move' else 'updated',
+                      'id': item.id}
+        touched.add(item.category_id)
+        results.append(result)
+
+    # the new items get their ids when they are written
+    session.flush()
+    for item, result in created:
+        result['id'] = item.id
+    refreshSnapshot(items=[r['id'] for r in results if 'id' in r and
+                           r['status'] != 'error'])
+    session.commit()
+    cache.invalidate('counts', *['category:%d' % c for c in touched] +
+                     ['item:%d' % r['id'] for r in results
+                      if r['status'] in ('updated', 'moved', 'deleted')])
+
+    # remove the images of deleted items once nothing else uses them
+    deleteFiles(*deleted_images)
+    return jsonify(results=results)
+
+
+# route and method for searching item and category names and descriptions
+# (see search.py) - results are ranked best match first
+@app.route('/search')
+def searchCatalog():
+    query = request.args.get('q', '')
+    limit = app.config['SEARCH_LIMIT']
+    categories = search.search(session, Category, query, limit)
+    items = search.search(session, Item, query, limit)
+    return render_template('search.html', query=query, categories=categories,
+                           items=items, user_status=userStatus())
+
+
 def userStatus(creator_id=None):
     # this function will be used by the template engine to show
     # or hide add, edit and delete links
@@ -300,52 +761,149 @@ def userStatus(creator_id=None):
 # use JSONIFY to return JSON endpoints for categories, items by category,
 # and item details
 
+# the list endpoints are paginated (see paginate) - 'next' holds the link to
+# the following page, or null on the last one.  Categories and items are sent
+# as already encoded in the catalog snapshot (see snapshot.py) wherever
+# possible.
+
 # creates a JSON endpoint containing a list of all categories
 @app.route('/categories/json')
+@conditional(categoriesVersion)
+@cache.cached('categories')
 def categoriesJSON():
-    categories = session.query(Category).all()
-    return jsonify(categories=[c.serialize for c in categories])
+    rows, next_url = paginate(
+        session.query(CatalogSnapshot.category_id,
+                      CatalogSnapshot.category_json),
+        CatalogSnapshot.category_id)
+    return jsonResponse('{"categories": [%s], "next": %s}' % (
+        ', '.join(row.category_json for row in rows), json.dumps(next_url)))
 
 
 # create a JSON endpoint containing a list of all items in a given category
 @app.route('/category/<int:category_id>/json')
+@conditional(categoryVersion)
+@cache.cached('category:{category_id}')
 def itemsByCategoryJSON(category_id):
-    items = session.query(Item).filter_by(category_id=category_id)
-    return jsonify(items=[i.serialize for i in items])
+    items = session.query(ItemSnapshot.item_id, ItemSnapshot.item_json).\
+        filter(ItemSnapshot.category_id == category_id)
+
+    # as NDJSON, every item of the category is streamed, one per line
+    if wantsNDJSON():
+        rows = items.order_by(ItemSnapshot.item_id).yield_per(1000)
+        return ndjsonResponse(row.item_json for row in rows)
+
+    rows, next_url = paginate(items, ItemSnapshot.item_id)
+    return jsonResponse('{"items": [%s], "next": %s}' % (
+        ', '.join(row.item_json for row in rows), json.dumps(next_url)))
 
 
 # create a JSON endpoint for all items grouped by category
+# each category and its items are already encoded in the catalog snapshot,
+# and are streamed out a category at a time, so the whole catalog is never
+# held in memory at once.  As NDJSON each line is a category with its items.
 @app.route('/catalog/json')
+@conditional(catalogVersion)
 def itemsAllJSON():
-    catalog = []
-    categories = session.query(Category).all()
-    for c in categories:
-        c_group = c.serialize
-        items = session.query(Item).filter_by(category_id=c.id).all()
-        item_list = []
-        for i in items:
-            item_list.append(i.serialize)
-        c_group['items'] = item_list
-        catalog.append(c_group)
-    return jsonify(catalog=[catalog])
+    # one query for every category and item, in category order
+    rows = session.query(CatalogSnapshot.category_id,
+                         CatalogSnapshot.category_json,
+                         ItemSnapshot.item_json).\
+        outerjoin(ItemSnapshot,
+                  ItemSnapshot.category_id == CatalogSnapshot.category_id).\
+        order_by(CatalogSnapshot.category_id, ItemSnapshot.item_id).\
+        yield_per(1000)
+
+    def categories():
+        # each category's JSON, with its items added on the end
+        for category_id, group in itertools.groupby(rows,
+                                                    lambda row: row[0]):
+            first = next(group)
+            items = itertools.chain([first], group) \
+                if first.item_json is not None else []
+            yield '%s, "items": [%s]}' % (
+                first.category_json[:-1],
+                ', '.join(row.item_json for row in items))
+
+    if wantsNDJSON():
+        return ndjsonResponse(categories())
+
+    def generate():
+        yield '{"catalog": [['
+        for n, category in enumerate(categories()):
+            yield (', ' if n else '') + category
+        yield ']]}'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
 
 
 # create a JSON endpoint for a specific item
 @app.route('/item/<int:item_id>/json')
+@conditional(itemVersion)
+@cache.cached('item:{item_id}')
 def itemJSON(item_id):
-    item = session.query(Item).filter_by(id=item_id).one()
-    return jsonify(item=[item.serialize])
+    row = snapshot.item_rows(session, Item.category_id.label('category_id')).\
+        filter(Item.id == item_id).one()
+    item = snapshot.serialize(row)
+    # the item's category name is included
+    cache.tag('category:%d' % item.pop('category_id'))
+    return jsonResponse(encoding.dumps({'item': [item]}))
+
+
+# create a JSON endpoint for a search of items and categories
+@app.route('/search/json')
+def searchJSON():
+    query = request.args.get('q', '')
+    limit = app.config['SEARCH_LIMIT']
+    categories = search.search(session, Category, query, limit)
+    items = search.search(session, Item, query, limit)
+    # read the items' fields, with their category names, in one query
+    # rather than one per item, keeping the order of the results
+    ids = [i.id for i in items]
+    rows = dict((row.id, snapshot.serialize(row)) for row in
+                snapshot.item_rows(session).filter(Item.id.in_(ids))) \
+        if ids else {}
+    return jsonResponse(encoding.dumps({
+        'categories': [c.serialize for c in categories],
+        'items': [rows[i] for i in ids if i in rows]}))
+
+
+# create a JSON endpoint showing the background jobs (see jobs.py) - the
+# number in each status, and the latest jobs' names and statuses.  Only the
+# operators listed in config.py may see it.
+@app.route('/jobs/json')
+def jobsJSON():
+    if login_session.get('email') not in app.config['OPERATORS']:
+        response = jsonify(error='Only an operator may see the jobs')
+        response.status_code = 403
+        return response
+    return jsonify(**queue.summary())
 
 
 # code for dealing with logging users in and out
 # from Udacity Authorization and Authentication class
 
+# recently used users are kept, by id and by email, as plain dictionaries so
+# that logging in again doesn't need to go back to the database
+user_cache = LocalCache(app.config['USER_CACHE_SIZE'],
+                        app.config['USER_CACHE_TTL'])
+
+
+def cacheUser(user):
+    data = user.serialize
+    user_cache.set('user:%d' % user.id, data)
+    user_cache.set('email:%s' % user.email, data)
+    return data
+
+
 def getUserID(email):
-    try:
-        user = session.query(User).filter_by(email=email).one()
-        return user.id
-    except:
-        return None
+    data = user_cache.get('email:%s' % email)
+    if data is None:
+        try:
+            data = cacheUser(session.query(User).filter_by(email=email).one())
+        except:
+            return None
+    return data['id']
 
 
 def createUser(login_session):
@@ -353,20 +911,42 @@ def createUser(login_session):
                    'username'], email=login_session['email'])
     session.add(newUser)
     session.commit()
-    user = session.query(User).filter_by(email=login_session['email']).one()
-    return user.id
+    return cacheUser(newUser)['id']
 
 
 def getUserInfo(user_id):
-    user = session.query(User).filter_by(user_id=user_id).one()
-    return user
-
-# get the Google API client information
-CLIENT_ID = json.loads(
-    open('client_secrets.json', 'r').read())['web']['client_id']
+    data = user_cache.get('user:%d' % user_id)
+    if data is None:
+        user = session.query(User).filter_by(id=user_id).one()
+        cacheUser(user)
+        return user
+    # rebuild the user from the cache and attach it to the session without
+    # querying the database
+    user = User(**data)
+    make_transient_to_detached(user)
+    return session.merge(user, load=False)
+
+# get the Google and Facebook API client information, and set up pooled
+# connections to them (see auth.py)
+providers = auth.Providers(app.config)
+CLIENT_ID = providers.client_id
 APPLICATION_NAME = "Catalog"
 
 
+# revoke a token after logout, retried if the provider can't be reached
+@queue.task
+def revokeToken(provider, credential):
+    providers.revoke(provider, credential)
+
+
+# response for a login provider that didn't answer in time
+def providerTimeout():
+    response = make_response(json.dumps(
+        'login provider did not respond, please try again'), 504)
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
 @app.route('/login')
 def showLogin():
     # create a random string to be used as a CSRF token - we'll check it again
@@ -379,6 +959,7 @@ def showLogin():
 
 # Google Login
 @app.route('/gconnect', methods=['POST'])
+@limiter.limit('login')
 def gConnect():
     # Validate state token - check for hijack
     if request.args.get('state') != login_session['state']:
@@ -389,11 +970,15 @@ def gConnect():
     # Obtain authorization code - obtained from javascript in login.html
     code = request.data
 
+    # the calls to Google must all be done by this deadline
+    deadline = providers.deadline()
+
     try:
         # exchange the authorization code for a credentials object
-        oauth_flow = flow_from_clientsecrets('client_secrets.json', scope='')
-        oauth_flow.redirect_uri = 'postmessage'
-        credentials = oauth_flow.step2_exchange(code)
+        credentials = providers.call(deadline, providers.google_exchange,
+                                     code)
+    except auth.ProviderTimeout:
+        return providerTimeout()
     except:
         response = make_response(json.dumps('authorization unsucessful'), 401)
         response.headers['Content-Type'] = 'application/json'
@@ -401,11 +986,14 @@ def gConnect():
 
     access_token = credentials.access_token
 
-    # check that the access token we got is valid
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s'
-           % access_token)
-    h = httplib2.Http()
-    result = json.loads(h.request(url, 'GET')[1])
+    # check that the access token we got is valid, and get the user info
+    # from the Google API at the same time
+    try:
+        result, data = providers.concurrently(
+            deadline, (providers.google_tokeninfo, access_token),
+            (providers.google_userinfo, access_token))
+    except auth.ProviderTimeout:
+        return providerTimeout()
 
     if result.get('error') is not None:
         response = make_response(json.dumps("result.get('error')"), 500)
@@ -435,16 +1023,12 @@ def gConnect():
         response.headers['Content-Type'] = 'application/json'
         return response
 
-    # everything checks out, so save the credentials to the session
+    # everything checks out, so save the credentials to the session, under a
+    # new session id
+    regenerate(login_session)
     login_session['credentials'] = credentials.access_token
     login_session['g_id'] = g_id
 
-    # get the user info from the Google API
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': credentials.access_token, 'alt': 'json'}
-    reply = requests.get(userinfo_url, params=params)
-    data = reply.json()
-
     login_session['provider'] = 'google'
     login_session['username'] = data['name']
     login_session['email'] = data['email']
@@ -466,6 +1050,7 @@ def gConnect():
 
 # Facebook Login
 @app.route('/fbconnect', methods=['POST'])
+@limiter.limit('login')
 def fbconnect():
 
     if request.args.get('state') != login_session['state']:
@@ -473,28 +1058,17 @@ def fbconnect():
         response.headers['Content-Type'] = 'application/json'
         return response
     access_token = request.data
-    # Exchange client token for long-lived server-side token
-
-    app_id = json.loads(open('fb_client_secrets.json',
-                             'r').read())['web']['app_id']
-    app_secret = json.loads(open('fb_client_secrets.json',
-                                 'r').read())['web']['app_secret']
-
-    url = ('https://graph.facebook.com/oauth/access_token?'
-           'grant_type=fb_exchange_token&client_id=%s&client_secret=%s'
-           '&fb_exchange_token=%s' % (app_id, app_secret, access_token))
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-
-    # use token to get user infor from API
-    userinfo_url = 'https://graph.facebook.com/v2.2/me'
-    # strip expire tage from access token
-    token = result.split("&")[0]
-
-    url = 'https://graph.facebook.com/v2.2/me?%s&fields=name,id,email' % token
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-    data = json.loads(result)
+    deadline = providers.deadline()
+    try:
+        # Exchange client token for long-lived server-side token
+        token = providers.call(deadline, providers.facebook_exchange,
+                               access_token)
+
+        # use token to get user infor from API
+        data = providers.call(deadline, providers.facebook_userinfo, token)
+    except auth.ProviderTimeout:
+        return providerTimeout()
+    regenerate(login_session)
     login_session['provider'] = 'facebook'
     login_session['username'] = data["name"]
     login_session['email'] = data["email"]
@@ -534,10 +1108,10 @@ def logout():
 @app.route('/fbdisconnect')
 def fbdisconnect():
     facebook_id = login_session['facebook_id']
-    url = 'https://graph.facebook.com/%s/permissions' % facebook_id
-    h = httplib2.Http()
-    result = h.request(url, 'DELETE')[1]
+    # the permissions are revoked in the background
+    queue.enqueue('revokeToken', 'facebook', facebook_id)
     login_session.clear()
+    regenerate(login_session)
     return "you have been logged out"
 
 # Google Disconnect
@@ -552,24 +1126,49 @@ def gdisconnect():
             'Current user not connected'), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
-    # Execute HTTP GET request to revoke current token
+    # revoke the current token in the background, so logging out doesn't
+    # wait for Google - a failure is logged (see auth.py)
     access_token = credentials
-    url = 'https://accounts.google.com/o/oauth2/revoke?token=%s' % access_token
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[0]
-
-    if result['status'] == '200':
-        # Reset the user's session
-        login_session.clear()
-        response = "Successfully Disconnected"
-        return response
-    else:
-        # an error where the given token was invalid
-        response = "Error logging out"
-        return response
-
+    queue.enqueue('revokeToken', 'google', access_token)
 
+    # Reset the user's session
+    login_session.clear()
+    regenerate(login_session)
+    response = "Successfully Disconnected"
+    return response
+
+
+# pages built at startup so that they are cached before the first visitor
+WARM_PATHS = ['/', '/categories/json']
+
+
+# get the app ready to serve - importing this module has no side effects on
+# the database, so the schema is only created or upgraded here when migrate
+# is set (the production server upgrades it once, before starting any
+# workers - see gunicorn.conf.py).  Every template is compiled, a database
+# connection opened and the WARM_PATHS cached, so the first requests to a
+# new worker are as fast as the rest.  The compressed copies of the static
+# files are brought up to date.
+def create_app(migrate=False):
+    if not app.secret_key:
+        if not app.debug:
+            raise RuntimeError('CATALOG_SECRET_KEY must be set')
+        app.secret_key = os.urandom(24)
+    if migrate:
+        upgrade(engine)
+    queue.start()
+    assets.precompress(app.static_folder)
+
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    with app.test_client() as client:
+        for path in WARM_PATHS:
+            client.get(path)
+    return app
+
+
+# the development server - use wsgi.py for anything else
 if __name__ == '__main__':
-    app.secret_key = 'blahblahblah'
     app.debug = True
+    create_app(migrate=True)
     app.run(host='0.0.0', port=8000)
@@ -1,7 +1,11 @@
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Index
+from sqlalchemy import Text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
+from sqlalchemy.orm import relationship, deferred
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+from datetime import datetime
+import config
 
 Base = declarative_base()
 
@@ -10,7 +14,7 @@ class User(Base):
 	__tablename__ = 'user'
 	id = Column(Integer, primary_key = True)
 	name = Column(String(250), nullable = False)
-	email = Column(String(250))
+	email = Column(String(250), unique = True, index = True)
 
 	@property
 	def serialize(self):
@@ -24,12 +28,18 @@ class User(Base):
 class Category(Base):
 	__tablename__ = 'category'
 	id = Column(Integer, primary_key = True)
-	name = Column(String(250), nullable = False)
+	name = Column(String(250), nullable = False, index = True)
 	description = Column(String(250))
-	icon = Column(String(250))
-	user_id = Column(Integer, ForeignKey('user.id'))
+	icon = Column(String(250), index = True)
+	user_id = Column(Integer, ForeignKey('user.id'), index = True)
 	user = relationship(User)
 	item = relationship("Item", cascade="delete")
+	# time of the last change, used for ETag and Last-Modified headers
+	updated_at = Column(DateTime, default = datetime.utcnow,
+		onupdate = datetime.utcnow)
+	# item count and serialized category, loaded along with the category
+	snapshot = relationship("CatalogSnapshot", uselist = False,
+		viewonly = True, lazy = 'joined')
 
 	@property
 	def serialize(self):
@@ -44,15 +54,21 @@ class Category(Base):
 
 class Item(Base):
 	__tablename__ = 'item'
+	# items are looked up by category and name when importing (see bulk.py)
+	__table_args__ = (Index('ix_item_category_id_name', 'category_id', 'name'),)
 	id = Column(Integer, primary_key = True)
 	name = Column(String(250), nullable = False)
 	description = Column(String(250))
 	price = Column(String(10))
-	image = Column(String(250))
-	category_id = Column(Integer, ForeignKey('category.id'), nullable = False)
+	image = Column(String(250), index = True)
+	category_id = Column(Integer, ForeignKey('category.id'), nullable = False,
+		index = True)
 	category = relationship(Category)
-	user_id = Column(Integer, ForeignKey('user.id'))
+	user_id = Column(Integer, ForeignKey('user.id'), index = True)
 	user = relationship(User)
+	# time of the last change, used for ETag and Last-Modified headers
+	updated_at = Column(DateTime, default = datetime.utcnow,
+		onupdate = datetime.utcnow, index = True)
 
 	@property
 	def serialize(self):
@@ -67,6 +83,108 @@ class Item(Base):
 			'user_id' : self.user_id
 		}
 
-engine = create_engine('sqlite:///catalog.db')
+class CatalogSnapshot(Base):
+	# precomputed copy of each category for the read paths, kept up to date
+	# by the write routes (see snapshot.py)
+	__tablename__ = 'catalog_snapshot'
+	category_id = Column(Integer, ForeignKey('category.id', ondelete = 'CASCADE'),
+		primary_key = True)
+	item_count = Column(Integer, nullable = False, default = 0)
+	# the category's serialize, already JSON encoded
+	category_json = deferred(Column(Text, nullable = False))
+	updated_at = Column(DateTime, default = datetime.utcnow)
+
+class ItemSnapshot(Base):
+	# precomputed copy of each item for the read paths, a row per item so a
+	# change to one item only rewrites its own row (see snapshot.py)
+	__tablename__ = 'item_snapshot'
+	item_id = Column(Integer, ForeignKey('item.id', ondelete = 'CASCADE'),
+		primary_key = True)
+	category_id = Column(Integer, ForeignKey('category.id', ondelete = 'CASCADE'),
+		nullable = False, index = True)
+	# the item's serialize, already JSON encoded
+	item_json = Column(Text, nullable = False)
+
+class SnapshotState(Base):
+	# a single row about the snapshot as a whole - when a category was last
+	# deleted, which the rows of the categories left can't show (see
+	# snapshot.py)
+	__tablename__ = 'snapshot_state'
+	id = Column(Integer, primary_key = True)
+	category_deleted_at = Column(DateTime)
+
+def get_engine(settings=None, read_only=False):
+	# create an engine for the configured database - settings is a mapping
+	# such as the Flask app.config, and defaults to the values in config.py.
+	# A read_only engine connects to DATABASE_READ_URL if it is set, and each
+	# of its transactions reads from a single snapshot of the database
+	if settings is None:
+		settings = config.settings()
+	url = settings['DATABASE_URL']
+	if read_only and settings['DATABASE_READ_URL']:
+		url = settings['DATABASE_READ_URL']
+	pool = {
+		'pool_size' : settings['DATABASE_POOL_SIZE'],
+		'max_overflow' : settings['DATABASE_MAX_OVERFLOW'],
+		'pool_timeout' : settings['DATABASE_POOL_TIMEOUT'],
+		'pool_recycle' : settings['DATABASE_POOL_RECYCLE']
+	}
+	if not url.startswith('sqlite'):
+		if read_only:
+			# a repeatable read transaction keeps to the snapshot its first
+			# query saw, on PostgreSQL and MySQL replicas alike
+			return create_engine(url, isolation_level = 'REPEATABLE READ',
+				**pool)
+		return create_engine(url, **pool)
+
+	# pooled connections are only used by one thread at a time, so sqlite's
+	# same-thread check can be switched off
+	engine = create_engine(url, poolclass = QueuePool,
+		connect_args = {'check_same_thread' : False}, **pool)
+
+	@event.listens_for(engine, 'connect')
+	def set_sqlite_pragmas(dbapi_connection, connection_record):
+		cursor = dbapi_connection.cursor()
+		cursor.execute('PRAGMA journal_mode=%s' % settings['SQLITE_JOURNAL_MODE'])
+		cursor.execute('PRAGMA synchronous=%s' % settings['SQLITE_SYNCHRONOUS'])
+		cursor.execute('PRAGMA mmap_size=%d' % settings['SQLITE_MMAP_SIZE'])
+		cursor.execute('PRAGMA cache_size=%d' % settings['SQLITE_CACHE_SIZE'])
+		cursor.execute('PRAGMA busy_timeout=%d' % settings['SQLITE_BUSY_TIMEOUT'])
+		if read_only:
+			cursor.execute('PRAGMA query_only=ON')
+			# leave beginning transactions to begin_snapshot
+			dbapi_connection.isolation_level = None
+		cursor.close()
+
+	if read_only:
+		# pysqlite doesn't begin a transaction before a SELECT, so every query
+		# would see the database as it was at that moment.  Beginning one
+		# explicitly makes all the queries of a request read the same WAL
+		# snapshot, without holding up writers.
+		@event.listens_for(engine, 'begin')
+		def begin_snapshot(connection):
+			connection.connection.execute('BEGIN')
+
+	return engine
+
+def get_read_engine(settings=None):
+	# the engine the GET routes read from (see routing.py) - a replica at
+	# DATABASE_READ_URL, or read-only connections to a sqlite DATABASE_URL -
+	# or None to read from the primary
+	if settings is None:
+		settings = config.settings()
+	if not settings['READ_ROUTING']:
+		return None
+	if settings['DATABASE_READ_URL']:
+		return get_engine(settings, read_only = True)
+	url = settings['DATABASE_URL']
+	# an in-memory database can't be opened a second time
+	if url.startswith('sqlite') and url not in ('sqlite://',
+			'sqlite:///:memory:'):
+		return get_engine(settings, read_only = True)
+	return None
 
-Base.metadata.create_all(engine)
\ No newline at end of file
+# create the tables, or upgrade an existing database to the current schema
+if __name__ == '__main__':
+	from migrations import upgrade
+	upgrade(get_engine())
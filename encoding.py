@@ -0,0 +1,113 @@
+# JSON encoding and compression for the JSON API
+#
+# dumps() uses the fastest JSON encoder installed - orjson, then ujson, then
+# the standard library - and writes compact JSON.  The JSON endpoints read
+# the columns they need as plain row tuples (see snapshot.py) instead of
+# loading ORM objects, and encode them with it.
+#
+# compress() is run on every response.  JSON and NDJSON responses are sent
+# compressed with brotli (if the brotli package is installed) or gzip when
+# the client accepts it, a chunk at a time for streamed responses.  Their
+# ETags become weak, as the compressed bytes differ from the uncompressed
+# ones (cache.conditional compares ETags weakly).
+import json
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = ('application/json', 'application/x-ndjson')
+
+
+def dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value).decode('utf-8')
+    if ujson is not None:
+        # a UTF-8 str on Python 2, which sqlite won't take for a Text column
+        data = ujson.dumps(value, ensure_ascii=False)
+        return data.decode('utf-8') if isinstance(data, bytes) else data
+    return json.dumps(value, separators=(',', ':'))
+
+
+class Gzip(object):
+
+    def __init__(self, level):
+        # wbits of 16 + MAX_WBITS writes a gzip header and trailer
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                           16 + zlib.MAX_WBITS)
+
+    def process(self, data):
+        return self.compressor.compress(data)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class Brotli(object):
+
+    def __init__(self, quality):
+        self.compressor = brotli.Compressor(quality=quality)
+
+    def process(self, data):
+        return self.compressor.process(data)
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+def compressor(request, settings):
+    # the (encoding name, compressor) to use for this request, or None
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br', Brotli(settings['BROTLI_QUALITY'])
+    if accepted['gzip']:
+        return 'gzip', Gzip(settings['GZIP_LEVEL'])
+    return None
+
+
+def compress_stream(chunks, codec):
+    for chunk in chunks:
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        data = codec.process(chunk)
+        if data:
+            yield data
+    yield codec.finish()
+
+
+def compress(request, response, settings):
+    if (not settings['COMPRESS_JSON'] or response.status_code != 200 or
+            response.mimetype not in COMPRESSIBLE or
+            'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    if (not response.is_streamed and
+            (response.content_length or 0) < settings['COMPRESS_MIN_SIZE']):
+        return response
+    chosen = compressor(request, settings)
+    if chosen is None:
+        return response
+
+    name, codec = chosen
+    if response.is_streamed:
+        response.response = compress_stream(response.response, codec)
+    else:
+        response.set_data(codec.process(response.get_data()) +
+                          codec.finish())
+    response.headers['Content-Encoding'] = name
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,45 @@
+# gunicorn settings for the catalog (see wsgi.py), taken from config.py
+#
+# usage: gunicorn -c gunicorn.conf.py wsgi:app
+#
+# Each of WSGI_WORKERS processes serves up to WSGI_THREADS requests at once.
+# The app isn't preloaded: every worker imports it itself, so the thread
+# pools and database connections it sets up are its own rather than copies
+# made by fork.  The schema is upgraded and the static files compressed once,
+# in the master process, before any workers start.
+#
+# Reloading without downtime:
+#   kill -HUP <master pid>   starts workers running the current code and
+#                            settings, then stops the old ones once they have
+#                            finished their requests (WSGI_GRACEFUL_TIMEOUT)
+#   kill -USR2 <master pid>  starts a whole new master alongside the old one,
+#                            for upgrading gunicorn or Python itself - send
+#                            the old master TERM once the new one is serving
+import os
+
+import config
+
+bind = config.WSGI_BIND
+workers = config.WSGI_WORKERS
+threads = config.WSGI_THREADS
+worker_class = 'gthread'
+timeout = config.WSGI_TIMEOUT
+graceful_timeout = config.WSGI_GRACEFUL_TIMEOUT
+# replace workers now and then so they can't grow without limit, staggered so
+# they don't all restart at once
+max_requests = config.WSGI_MAX_REQUESTS
+max_requests_jitter = config.WSGI_MAX_REQUESTS // 10
+preload_app = False
+
+
+def on_starting(server):
+    # create the tables or bring the schema up to date before serving
+    from database_setup import get_engine
+    from migrations import upgrade
+    engine = get_engine()
+    upgrade(engine)
+    engine.dispose()
+    # compress the static files once, rather than in every worker at once
+    from assets import precompress
+    precompress(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'static'))
@@ -0,0 +1,90 @@
+# Resized copies of uploaded images
+# Every upload is kept at full size and also resized, by a background job
+# (see jobs.py), into a fixed set of variants - icon, list and detail - each
+# saved as WebP and in the format of the original.  The templates show the
+# variant that fits (see templates/macros.html) and fall back to the original
+# until the variants exist.
+#
+# Resizing needs the Pillow package; without it only the originals are kept.
+import os
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# largest width in pixels of each variant - twice the width it is shown at,
+# so it stays sharp on high resolution screens
+SIZES = {
+    'icon': 100,
+    'list': 200,
+    'detail': 400,
+}
+
+FORMATS = {
+    'jpg': 'JPEG',
+    'jpeg': 'JPEG',
+    'png': 'PNG',
+    'gif': 'GIF',
+    'webp': 'WEBP',
+}
+
+
+def variant_name(filename, size, extension=None):
+    # e.g. ABCD1234.jpg -> ABCD1234.icon.jpg, or ABCD1234.icon.webp
+    name, original = filename.rsplit('.', 1)
+    return '%s.%s.%s' % (name, size, extension or original)
+
+
+def variant_names(filename):
+    for size in SIZES:
+        yield variant_name(filename, size)
+        yield variant_name(filename, size, 'webp')
+
+
+def make_variants(folder, filename):
+    # resize one upload into all of its variants
+    original = Image.open(os.path.join(folder, filename))
+    original.load()
+    for size, width in SIZES.items():
+        image = original
+        if image.size[0] > width:
+            height = max(1, image.size[1] * width // image.size[0])
+            image = image.resize((width, height), Image.LANCZOS)
+
+        for extension in (filename.rsplit('.', 1)[1], 'webp'):
+            image_format = FORMATS[extension.lower()]
+            variant = image
+            if image_format == 'JPEG' and variant.mode not in ('RGB', 'L'):
+                variant = variant.convert('RGB')
+            # write to a temporary name and rename, so a half written file is
+            # never served
+            path = os.path.join(folder, variant_name(filename, size,
+                                                     extension))
+            variant.save(path + '.tmp', image_format, quality=85,
+                         optimize=True)
+            os.rename(path + '.tmp', path)
+
+
+def resizable(filename):
+    # can variants of this upload be made?
+    return (Image is not None and
+            filename.rsplit('.', 1)[1].lower() in FORMATS)
+
+
+def thumbnail(folder, filename, size, extension=None):
+    # the name of an upload's variant if it has been made, otherwise None
+    if not filename:
+        return None
+    name = variant_name(filename, size, extension)
+    if os.path.isfile(os.path.join(folder, name)):
+        return name
+    return None
+
+
+def delete_variants(folder, filename):
+    for name in variant_names(filename):
+        path = os.path.join(folder, name)
+        if os.path.isfile(path):
+            os.remove(path)
@@ -0,0 +1,269 @@
+# Background jobs for the work a request can leave until after it has
+# answered - removing uploads nothing uses any more, resizing new uploads and
+# revoking login tokens.
+#
+# A job is the name of a function registered with Queue.task and its
+# arguments, which must be JSON values.  JOB_WORKERS threads in each server
+# process run the jobs in the order they are due.  A job that raises is
+# retried up to JOB_RETRIES times, waiting JOB_RETRY_DELAY seconds before the
+# first retry and twice as long before each one after that.
+#
+# Jobs are kept in one of these stores, chosen by JOB_STORE:
+#   memory - in the server process, so jobs not yet run are lost if it stops
+#   sqlite - in a local sqlite file (JOB_FILE) shared by every process on the
+#            machine, so they survive a restart.  A running job is leased to
+#            its worker for JOB_LEASE seconds; if the process dies, another
+#            one runs the job again when the lease runs out.
+# Finished jobs are forgotten once there are more than JOB_HISTORY of them;
+# failed ones are kept.
+import heapq
+import itertools
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+
+log = logging.getLogger(__name__)
+
+# seconds an idle worker waits before looking for due jobs again
+POLL_INTERVAL = 0.5
+
+# the fields of a job that summary() shows - the arguments and errors can
+# hold secrets such as the access tokens waiting to be revoked
+SUMMARY_FIELDS = ('id', 'name', 'status', 'attempts')
+
+
+class MemoryStore(object):
+
+    def __init__(self, history):
+        self.history = history
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.jobs = OrderedDict()
+        # (run at, id) of the jobs waiting to run
+        self.pending = []
+        self.finished = deque()
+
+    def add(self, name, args, run_at):
+        with self.lock:
+            job_id = next(self.ids)
+            self.jobs[job_id] = {'id': job_id, 'name': name, 'args': args,
+                                 'status': 'queued', 'attempts': 0,
+                                 'error': None, 'run_at': run_at,
+                                 'updated': time.time()}
+            heapq.heappush(self.pending, (run_at, job_id))
+            return job_id
+
+    def claim(self, lease_until):
+        # the next job that is due, marked as running, or None
+        with self.lock:
+            if not self.pending or self.pending[0][0] > time.time():
+                return None
+            run_at, job_id = heapq.heappop(self.pending)
+            job = self.jobs[job_id]
+            job.update(status='running', attempts=job['attempts'] + 1,
+                       updated=time.time())
+            return dict(job)
+
+    def retry(self, job_id, error, run_at):
+        with self.lock:
+            self.jobs[job_id].update(status='queued', error=error,
+                                     run_at=run_at, updated=time.time())
+            heapq.heappush(self.pending, (run_at, job_id))
+
+    def finish(self, job_id, status, error=None):
+        with self.lock:
+            self.jobs[job_id].update(status=status, error=error,
+                                     updated=time.time())
+            if status == 'done':
+                self.finished.append(job_id)
+                while len(self.finished) > self.history:
+                    del self.jobs[self.finished.popleft()]
+
+    def summary(self, limit):
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job['status']] = counts.get(job['status'], 0) + 1
+            recent = [dict(job) for job in
+                      list(self.jobs.values())[-limit:]][::-1]
+        return counts, recent
+
+
+class SqliteStore(object):
+    # every thread has its own connection, as in sessions.SqliteStore
+
+    COLUMNS = ['id', 'name', 'args', 'status', 'attempts', 'error', 'run_at',
+               'updated']
+
+    def __init__(self, path, history):
+        self.path = path
+        self.history = history
+        self.local = threading.local()
+        connection = self.connection()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS jobs '
+            '(id INTEGER PRIMARY KEY, name TEXT, args TEXT, status TEXT, '
+            'attempts INTEGER, error TEXT, run_at REAL, updated REAL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_jobs_status_run_at '
+                           'ON jobs (status, run_at)')
+
+    def connection(self):
+        if not hasattr(self.local, 'connection'):
+            connection = sqlite3.connect(self.path, timeout=10,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return self.local.connection
+
+    def job(self, row):
+        job = dict(zip(self.COLUMNS, row))
+        job['args'] = json.loads(job['args'])
+        return job
+
+    def add(self, name, args, run_at):
+        return self.connection().execute(
+            'INSERT INTO jobs (name, args, status, attempts, run_at, updated)'
+            " VALUES (?, ?, 'queued', 0, ?, ?)",
+            (name, json.dumps(args), run_at, time.time())).lastrowid
+
+    def claim(self, lease_until):
+        # a running job whose lease has run out was left by a process that
+        # stopped, so it is due again
+        connection = self.connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT %s FROM jobs WHERE status IN (?, ?) AND run_at <= ? '
+                'ORDER BY run_at, id LIMIT 1' % ', '.join(self.COLUMNS),
+                ('queued', 'running', now)).fetchone()
+            if row is not None:
+                connection.execute(
+                    "UPDATE jobs SET status = 'running', "
+                    'attempts = attempts + 1, run_at = ?, updated = ? '
+                    'WHERE id = ?', (lease_until, now, row[0]))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        job = self.job(row)
+        job.update(status='running', attempts=job['attempts'] + 1)
+        return job
+
+    def retry(self, job_id, error, run_at):
+        self.connection().execute(
+            "UPDATE jobs SET status = 'queued', error = ?, run_at = ?, "
+            'updated = ? WHERE id = ?', (error, run_at, time.time(), job_id))
+
+    def finish(self, job_id, status, error=None):
+        connection = self.connection()
+        connection.execute(
+            'UPDATE jobs SET status = ?, error = ?, updated = ? WHERE id = ?',
+            (status, error, time.time(), job_id))
+        # now and then forget the oldest finished jobs
+        if status == 'done' and random.random() < 0.01:
+            connection.execute(
+                "DELETE FROM jobs WHERE status = 'done' AND id NOT IN "
+                "(SELECT id FROM jobs WHERE status = 'done' "
+                'ORDER BY id DESC LIMIT ?)', (self.history,))
+
+    def summary(self, limit):
+        connection = self.connection()
+        counts = dict(connection.execute(
+            'SELECT status, COUNT(*) FROM jobs GROUP BY status'))
+        recent = [self.job(row) for row in connection.execute(
+            'SELECT %s FROM jobs ORDER BY id DESC LIMIT ?' %
+            ', '.join(self.COLUMNS), (limit,))]
+        return counts, recent
+
+
+class Queue(object):
+
+    def __init__(self, store, workers, retries, retry_delay, lease):
+        self.store = store
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.lease = lease
+        self.workers = workers
+        self.tasks = {}
+        self.wake = threading.Event()
+        self.started = False
+
+    def start(self):
+        # start the worker threads, once every task has been registered
+        if self.started:
+            return
+        self.started = True
+        for n in range(self.workers):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+    def task(self, function):
+        # decorator registering a function that jobs can run, by its name
+        self.tasks[function.__name__] = function
+        return function
+
+    def enqueue(self, name, *args):
+        # add a job to run name(*args) as soon as a worker is free
+        job_id = self.store.add(name, list(args), time.time())
+        self.wake.set()
+        return job_id
+
+    def work(self):
+        while True:
+            try:
+                job = self.store.claim(time.time() + self.lease)
+            except Exception:
+                log.exception('could not claim a job')
+                job = None
+            if job is None:
+                self.wake.wait(POLL_INTERVAL)
+                self.wake.clear()
+                continue
+            self.run(job)
+
+    def run(self, job):
+        try:
+            self.tasks[job['name']](*job['args'])
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+            if job['attempts'] <= self.retries:
+                log.warning('job %s %s failed, will retry: %s', job['id'],
+                            job['name'], error)
+                self.store.retry(job['id'], error, time.time() +
+                                 self.retry_delay *
+                                 2 ** (job['attempts'] - 1))
+            else:
+                log.exception('job %s %s failed', job['id'], job['name'])
+                self.store.finish(job['id'], 'failed', error)
+        else:
+            self.store.finish(job['id'], 'done')
+
+    def summary(self, limit=50):
+        # the number of jobs in each status, and the most recent jobs
+        # without their arguments or errors
+        counts, recent = self.store.summary(limit)
+        return {'counts': counts,
+                'recent': [dict((field, job[field]) for field in
+                                SUMMARY_FIELDS) for job in recent]}
+
+
+def make_queue(settings):
+    # the job queue for JOB_STORE
+    store = settings['JOB_STORE']
+    if store == 'memory':
+        backend = MemoryStore(settings['JOB_HISTORY'])
+    elif store == 'sqlite':
+        backend = SqliteStore(settings['JOB_FILE'], settings['JOB_HISTORY'])
+    else:
+        raise ValueError('unknown job store %r' % store)
+    return Queue(backend, settings['JOB_WORKERS'], settings['JOB_RETRIES'],
+                 settings['JOB_RETRY_DELAY'], settings['JOB_LEASE'])
@@ -0,0 +1,287 @@
+# Per-request instrumentation, switched on with METRICS_ENABLED
+#
+# For every request the time spent running SQL (and the number of
+# statements), rendering templates and saving uploads is added up and sent
+# back in a Server-Timing header, which browser developer tools show next to
+# the request.  The same figures, with the total time of each request, are
+# collected per route and served from /metrics in the Prometheus text format.
+# They are kept in each server process, so with several workers every process
+# has its own.
+#
+# With PROFILE_SLOW_MS set, a background thread samples the stack of every
+# thread serving a request each PROFILE_INTERVAL seconds.  The stacks of a
+# request that takes longer than PROFILE_SLOW_MS are written to PROFILE_DIR
+# in the folded format read by flamegraph.pl and speedscope.
+#
+# Streamed responses (/catalog/json) are timed until the response starts.
+# Requests turned away by the rate limiter or admission control (see
+# ratelimit.py) are counted per route and reason.
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from flask import Response, current_app, g, request, has_request_context
+from sqlalchemy import event
+
+# upper bounds of the request duration histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def add(name, seconds, count=1):
+    # add time spent on part of the current request, e.g. 'sql'
+    if has_request_context() and hasattr(g, 'timings'):
+        g.timings[name] += seconds
+        g.counts[name] += count
+
+
+class timer(object):
+    # with timer('upload'): ... - adds the time the block takes to the
+    # current request
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+
+    def __exit__(self, *exc):
+        add(self.name, time.time() - self.started)
+
+
+def rejected(reason):
+    # count the current request as turned away, e.g. 'rate_limit'
+    if has_request_context():
+        metrics = current_app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.reject(request.url_rule.rule if request.url_rule
+                           else 'unmatched', reason)
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for n, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[n] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics(object):
+    # request durations per route and method, and request counts, time
+    # spent and rejected requests per route
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = defaultdict(Histogram)
+        self.requests = defaultdict(int)
+        self.totals = defaultdict(float)
+        self.counts = defaultdict(int)
+        self.rejections = defaultdict(int)
+
+    def record(self, route, method, status, duration, timings, counts):
+        with self.lock:
+            self.durations[(route, method)].observe(duration)
+            self.requests[(route, method, status)] += 1
+            for name, seconds in timings.items():
+                self.totals[(route, name)] += seconds
+                self.counts[(route, name)] += counts[name]
+
+    def reject(self, route, reason):
+        with self.lock:
+            self.rejections[(route, reason)] += 1
+
+    def render(self):
+        # the Prometheus text exposition format
+        lines = []
+        with self.lock:
+            lines.append('# HELP catalog_request_duration_seconds '
+                         'Time taken to build each response.')
+            lines.append('# TYPE catalog_request_duration_seconds histogram')
+            for (route, method), histogram in sorted(self.durations.items()):
+                labels = 'route="%s",method="%s"' % (route, method)
+                for bound, count in zip(BUCKETS, histogram.buckets):
+                    lines.append(
+                        'catalog_request_duration_seconds_bucket'
+                        '{%s,le="%s"} %d' % (labels, bound, count))
+                lines.append('catalog_request_duration_seconds_bucket'
+                             '{%s,le="+Inf"} %d' % (labels, histogram.count))
+                lines.append('catalog_request_duration_seconds_sum{%s} %f' % (
+                    labels, histogram.sum))
+                lines.append('catalog_request_duration_seconds_count{%s} %d'
+                             % (labels, histogram.count))
+
+            lines.append('# HELP catalog_requests_total Requests answered.')
+            lines.append('# TYPE catalog_requests_total counter')
+            for (route, method, status), count in \
+                    sorted(self.requests.items()):
+                lines.append('catalog_requests_total{route="%s",method="%s",'
+                             'status="%s"} %d' % (route, method, status,
+                                                  count))
+
+            lines.append('# HELP catalog_part_seconds_total Time spent on '
+                         'each part of the requests (sql, template, upload).')
+            lines.append('# TYPE catalog_part_seconds_total counter')
+            for (route, name), seconds in sorted(self.totals.items()):
+                lines.append('catalog_part_seconds_total{route="%s",'
+                             'part="%s"} %f' % (route, name, seconds))
+
+            lines.append('# HELP catalog_part_total Number of SQL statements,'
+                         ' templates rendered and uploads saved.')
+            lines.append('# TYPE catalog_part_total counter')
+            for (route, name), count in sorted(self.counts.items()):
+                lines.append('catalog_part_total{route="%s",part="%s"} %d' % (
+                    route, name, count))
+
+            lines.append('# HELP catalog_rejected_total Requests turned away '
+                         '(rate_limit, overloaded).')
+            lines.append('# TYPE catalog_rejected_total counter')
+            for (route, reason), count in sorted(self.rejections.items()):
+                lines.append('catalog_rejected_total{route="%s",reason="%s"} '
+                             '%d' % (route, reason, count))
+        return '\n'.join(lines) + '\n'
+
+
+class Sampler(object):
+    # samples the stacks of the threads serving requests every interval
+    # seconds, counting each distinct stack
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.active = {}
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def start(self):
+        with self.lock:
+            self.active[threading.current_thread().ident] = defaultdict(int)
+
+    def stop(self):
+        # returns the stacks sampled since start
+        with self.lock:
+            return self.active.pop(threading.current_thread().ident, {})
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, stacks in self.active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stacks[self.fold(frame)] += 1
+
+    def fold(self, frame):
+        # outermost call first, separated by semicolons
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append('%s:%s:%d' % (os.path.basename(code.co_filename),
+                                       code.co_name, frame.f_lineno))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+
+def write_profile(directory, route, duration, stacks):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    name = '%s-%s-%dms.folded' % (
+        time.strftime('%Y%m%d-%H%M%S'),
+        route.strip('/').replace('/', '_').replace('<', '').replace('>', '')
+        or 'home', duration * 1000)
+    with open(os.path.join(directory, name), 'w') as f:
+        for stack, count in stacks.items():
+            f.write('%s %d\n' % (stack, count))
+
+
+def timed_template_class(base):
+    # a Jinja template class that adds its rendering time to the request
+
+    class TimedTemplate(base):
+
+        def render(self, *args, **kwargs):
+            with timer('template'):
+                return base.render(self, *args, **kwargs)
+
+    return TimedTemplate
+
+
+def init_app(app, *engines):
+    # instrument the app and its database engines, if METRICS_ENABLED is set
+    if not app.config['METRICS_ENABLED']:
+        return None
+    metrics = Metrics()
+    app.extensions['metrics'] = metrics
+    slow = app.config['PROFILE_SLOW_MS'] / 1000.0
+    sampler = Sampler(app.config['PROFILE_INTERVAL']) if slow else None
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        context.query_started = time.time()
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        add('sql', time.time() - context.query_started)
+
+    for engine in engines:
+        if engine is not None:
+            event.listen(engine, 'before_cursor_execute',
+                         before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+    # templates already loaded keep their class, so this must run before
+    # the first page is rendered
+    app.jinja_env.template_class = timed_template_class(
+        app.jinja_env.template_class)
+
+    @app.before_request
+    def start_request():
+        g.started = time.time()
+        g.timings = defaultdict(float)
+        g.counts = defaultdict(int)
+        if sampler is not None:
+            sampler.start()
+
+    @app.after_request
+    def finish_request(response):
+        if not hasattr(g, 'started'):
+            return response
+        duration = time.time() - g.started
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.record(route, request.method, response.status_code,
+                       duration, g.timings, g.counts)
+
+        parts = ['%s;dur=%.1f;desc="%d"' % (name, seconds * 1000,
+                                            g.counts[name])
+                 for name, seconds in sorted(g.timings.items())]
+        parts.append('total;dur=%.1f' % (duration * 1000))
+        response.headers['Server-Timing'] = ', '.join(parts)
+
+        if sampler is not None:
+            stacks = sampler.stop()
+            if duration >= slow and stacks:
+                write_profile(app.config['PROFILE_DIR'], route, duration,
+                              stacks)
+        return response
+
+    @app.teardown_request
+    def stop_sampling(exception=None):
+        # a request that failed never reaches finish_request
+        if sampler is not None:
+            sampler.stop()
+
+    @app.route('/metrics')
+    def showMetrics():
+        return Response(metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    return metrics
@@ -0,0 +1,132 @@
+# Schema migrations for the catalog database
+# A new database is created straight from the models in database_setup.py.
+# An existing database records its schema version in the schema_version
+# table and is upgraded in place by running each migration it hasn't had yet.
+# Databases created before this table existed are treated as version 1.
+#
+# usage: python migrations.py
+from datetime import datetime
+from sqlalchemy import Table, Column, Integer, MetaData, select
+from database_setup import Base, User, Category, Item, CatalogSnapshot
+from database_setup import ItemSnapshot, SnapshotState
+from database_setup import get_engine
+import search
+import snapshot
+
+
+version_table = Table('schema_version', MetaData(),
+                      Column('version', Integer, nullable=False))
+
+
+def create_indexes(connection, *columns):
+    # create the indexes the models define on each of these columns
+    for column in columns:
+        for index in column.table.indexes:
+            if [c.name for c in index.columns] == [column.name]:
+                index.create(connection)
+
+
+# version 2 - indexes on the foreign keys used to list a category's items and
+# a user's categories and items, and a unique index on user email for login
+def add_lookup_indexes(connection):
+    create_indexes(connection, User.__table__.c.email,
+                   Category.__table__.c.user_id, Item.__table__.c.category_id,
+                   Item.__table__.c.user_id)
+
+
+# version 3 - the time each category and item was last changed, for the ETag
+# and Last-Modified headers.  Existing rows count as changed now.
+def add_updated_at(connection):
+    for table in (Category.__table__, Item.__table__):
+        column = table.c.updated_at
+        connection.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+            table.name, column.name,
+            column.type.compile(dialect=connection.dialect)))
+        connection.execute(table.update().values(updated_at=datetime.utcnow()))
+    create_indexes(connection, Item.__table__.c.updated_at)
+
+
+# version 4 - indexes on the image columns, for checking whether anything
+# still uses an uploaded file before it is deleted
+def add_image_indexes(connection):
+    create_indexes(connection, Category.__table__.c.icon,
+                   Item.__table__.c.image)
+
+
+# version 5 - the full text search index (see search.py)
+def add_search_index(connection):
+    search.create_index(connection)
+
+
+# version 6 - indexes on the natural keys used to match imported records to
+# existing rows - category name, and item category and name (see bulk.py)
+def add_natural_key_indexes(connection):
+    create_indexes(connection, Category.__table__.c.name)
+    for index in Item.__table__.indexes:
+        if index.name == 'ix_item_category_id_name':
+            index.create(connection)
+
+
+# version 7 - the precomputed catalog snapshot (see snapshot.py)
+def add_catalog_snapshot(connection):
+    # filled in by version 8, which changes its shape
+    CatalogSnapshot.__table__.create(connection)
+
+
+# version 8 - the items' snapshot moves from one JSON list per category to a
+# row per item, so changing an item doesn't rewrite its whole category.  The
+# snapshot only holds copies, so it is simply made again.
+def add_item_snapshot(connection):
+    CatalogSnapshot.__table__.drop(connection)
+    CatalogSnapshot.__table__.create(connection)
+    ItemSnapshot.__table__.create(connection)
+    snapshot.rebuild(connection)
+
+
+# version 9 - when a category was last deleted, for the Last-Modified of the
+# pages listing every category
+def add_snapshot_state(connection):
+    SnapshotState.__table__.create(connection)
+
+
+# migrations in order - MIGRATIONS[n] upgrades a database from version n + 1
+MIGRATIONS = [
+    add_lookup_indexes,
+    add_updated_at,
+    add_image_indexes,
+    add_search_index,
+    add_natural_key_indexes,
+    add_catalog_snapshot,
+    add_item_snapshot,
+    add_snapshot_state,
+]
+
+LATEST_VERSION = len(MIGRATIONS) + 1
+
+
+def upgrade(engine):
+    # bring the database up to the latest version in a single transaction
+    with engine.begin() as connection:
+        version_table.create(connection, checkfirst=True)
+        row = connection.execute(select([version_table.c.version])).first()
+
+        if row is None:
+            if engine.dialect.has_table(connection, Item.__tablename__):
+                version = 1
+            else:
+                Base.metadata.create_all(connection)
+                version = LATEST_VERSION
+            connection.execute(version_table.insert(), version=version)
+        else:
+            version = row[0]
+
+        for migration in MIGRATIONS[version - 1:]:
+            migration(connection)
+            version += 1
+            connection.execute(version_table.update(), version=version)
+
+    return version
+
+
+if __name__ == '__main__':
+    upgrade(get_engine())
@@ -0,0 +1,191 @@
+# Rate limiting and admission control for the write and login routes
+#
+# Every client has a token bucket for each kind of route - 'write' for the
+# form posts that change the catalog, 'login' for the provider logins.  A
+# bucket holds up to RATE_<KIND>_BURST tokens and is refilled at
+# RATE_<KIND>_PER_MINUTE; each POST takes a token, and a client with none
+# left gets a 429 saying when to try again.  Clients are told apart by IP
+# address, and logged in users also have buckets of their own, so neither a
+# shared address nor a user switching addresses gets round the limit.
+# (Behind a proxy the real client address must be passed on, e.g. with
+# werkzeug's ProxyFix.)
+#
+# The buckets are kept in each server process ('local') or shared by every
+# worker in redis at CACHE_URL ('redis'), chosen by RATE_LIMIT_BACKEND.
+#
+# Writes are also admitted only WRITE_CONCURRENCY at a time per process.  A
+# write that can't start within WRITE_QUEUE_TIMEOUT seconds gets a 503, so
+# under heavy load writes are turned away before they pile up waiting for
+# the database lock.  Rejected requests are counted by metrics.py.
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import request, make_response
+from flask import session as login_session
+
+import metrics
+
+
+class LocalBuckets(object):
+    # token buckets in this process, forgetting the least recently used once
+    # there are more than max_entries
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        # take a token - returns 0, or the seconds until one will be free
+        now = time.time()
+        with self.lock:
+            tokens, at = self.buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - at) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_entries:
+                self.buckets.popitem(last=False)
+        return wait
+
+
+# the same as LocalBuckets.take, run inside redis so that workers taking
+# from one bucket at once don't race.  The wait is returned as a string, as
+# redis would round a number to an integer.
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(state[1]) or burst
+local at = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + (now - at) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'at', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisBuckets(object):
+    # token buckets shared by every worker - needs the redis package
+
+    def __init__(self, url, prefix='catalog-rate:'):
+        import redis
+        self.client = redis.StrictRedis.from_url(url)
+        self.script = self.client.register_script(TAKE_SCRIPT)
+        self.prefix = prefix
+
+    def take(self, key, rate, burst):
+        return float(self.script(keys=[self.prefix + key],
+                                 args=[rate, burst, time.time()]))
+
+
+def make_buckets(settings):
+    # the buckets for RATE_LIMIT_BACKEND, or None to switch limiting off
+    backend = settings['RATE_LIMIT_BACKEND']
+    if backend == 'local':
+        return LocalBuckets(settings['RATE_LIMIT_MAX_KEYS'])
+    if backend == 'redis':
+        return RedisBuckets(settings['CACHE_URL'])
+    if backend == 'none':
+        return None
+    raise ValueError('unknown rate limit backend %r' % backend)
+
+
+class Admission(object):
+    # lets at most limit callers in at once, each waiting up to timeout
+    # seconds for a place
+
+    def __init__(self, limit, timeout):
+        self.limit = limit
+        self.timeout = timeout
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def enter(self):
+        # True once in, or False if no place came free in time
+        deadline = time.time() + self.timeout
+        with self.condition:
+            while self.active >= self.limit:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.active += 1
+            return True
+
+    def leave(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+
+def refuse(message, status, retry_after):
+    response = make_response(json.dumps(message), status)
+    response.headers['Content-Type'] = 'application/json'
+    response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+    return response
+
+
+class Limiter(object):
+
+    def __init__(self, buckets, settings):
+        self.buckets = buckets
+        self.rules = {
+            'write': (settings['RATE_WRITE_PER_MINUTE'] / 60.0,
+                      settings['RATE_WRITE_BURST']),
+            'login': (settings['RATE_LOGIN_PER_MINUTE'] / 60.0,
+                      settings['RATE_LOGIN_BURST']),
+        }
+        self.writes = Admission(settings['WRITE_CONCURRENCY'],
+                                settings['WRITE_QUEUE_TIMEOUT'])
+
+    def wait(self, kind):
+        # take a token from each of the client's buckets for this kind of
+        # route, returning the longest wait for one
+        if self.buckets is None:
+            return 0
+        rate, burst = self.rules[kind]
+        keys = ['%s:ip:%s' % (kind, request.remote_addr)]
+        if 'user_id' in login_session:
+            keys.append('%s:user:%s' % (kind, login_session['user_id']))
+        return max(self.buckets.take(key, rate, burst) for key in keys)
+
+    def limit(self, kind):
+        # decorator for a route - its POSTs are rate limited, and writes are
+        # also admitted a few at a time
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if request.method != 'POST':
+                    return f(*args, **kwargs)
+                wait = self.wait(kind)
+                if wait:
+                    metrics.rejected('rate_limit')
+                    return refuse('Too many requests, please slow down.',
+                                  429, wait)
+                if kind != 'write':
+                    return f(*args, **kwargs)
+                if not self.writes.enter():
+                    metrics.rejected('overloaded')
+                    return refuse('The catalog is busy, please try again.',
+                                  503, 1)
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    self.writes.leave()
+            return wrapper
+        return decorator
@@ -0,0 +1,53 @@
+# Sending the reads of GET requests to the read engine
+#
+# The session in catalog.py is a RoutingSession.  During GET and HEAD
+# requests its queries run on the read engine (see get_read_engine in
+# database_setup.py) - read-only connections to the sqlite file, or a replica
+# - and everywhere else, in POST requests, background jobs and scripts, on
+# the primary.  Long reads such as /catalog/json then read from a snapshot
+# instead of contending with the writes.
+#
+# A replica can lag behind the primary, so a user who has just changed
+# something reads from the primary for READ_YOUR_WRITES seconds afterwards,
+# going by the time of their last commit, kept in their login session.  Other
+# users may see the change a little later, and a page cached (see cache.py)
+# in that time can stay stale until CACHE_TTL - keep the replica's lag short.
+import time
+
+from flask import request, has_request_context
+from flask import session as login_session
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+READ_METHODS = ('GET', 'HEAD')
+
+
+def reading(read_your_writes):
+    # True in a GET request from someone who hasn't just written anything
+    if not has_request_context() or request.method not in READ_METHODS:
+        return False
+    wrote_at = login_session.get('wrote_at')
+    return wrote_at is None or time.time() - wrote_at >= read_your_writes
+
+
+class RoutingSession(Session):
+    # a session bound to the primary that reads from reader, if given,
+    # during GET requests
+
+    def __init__(self, reader=None, read_your_writes=0, **kwargs):
+        Session.__init__(self, **kwargs)
+        self.reader = reader
+        self.read_your_writes = read_your_writes
+
+    def get_bind(self, *args, **kwargs):
+        if (self.reader is not None and not self._flushing and
+                reading(self.read_your_writes)):
+            return self.reader
+        return Session.get_bind(self, *args, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def remember_write(session):
+    # note when this client last changed something
+    if has_request_context() and request.method not in READ_METHODS:
+        login_session['wrote_at'] = time.time()
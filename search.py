@@ -0,0 +1,130 @@
+# Full text search over item and category names and descriptions
+#
+# sqlite: FTS5 tables item_fts and category_fts index the item and category
+# tables, and triggers on those tables keep them in step with every insert,
+# update and delete.  Results are ranked by bm25, with name matches counting
+# more than description matches.
+# postgresql: GIN indexes on the tsvector of each table's name and
+# description, ranked by ts_rank.
+# Any other database, or a sqlite built without FTS5, falls back to unranked
+# LIKE matching.
+#
+# The search index is created with the tables for a new database, and by
+# migration 5 for an existing one.
+import re
+
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import joinedload
+from database_setup import Base, Category, Item
+
+TABLES = (Category.__table__, Item.__table__)
+
+SQLITE_INDEX = [
+    "CREATE VIRTUAL TABLE {table}_fts USING fts5(name, description, "
+    "content='{table}', content_rowid='id')",
+    "CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN "
+    "INSERT INTO {table}_fts(rowid, name, description) "
+    "VALUES (new.id, new.name, new.description); END",
+    "CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN "
+    "INSERT INTO {table}_fts({table}_fts, rowid, name, description) "
+    "VALUES ('delete', old.id, old.name, old.description); END",
+    "CREATE TRIGGER {table}_fts_update AFTER UPDATE OF name, description "
+    "ON {table} BEGIN "
+    "INSERT INTO {table}_fts({table}_fts, rowid, name, description) "
+    "VALUES ('delete', old.id, old.name, old.description); "
+    "INSERT INTO {table}_fts(rowid, name, description) "
+    "VALUES (new.id, new.name, new.description); END",
+    # index the rows that are already there
+    "INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')",
+]
+
+SQLITE_SEARCH = (
+    "SELECT rowid FROM {table}_fts WHERE {table}_fts MATCH :query "
+    "ORDER BY bm25({table}_fts, 10.0, 1.0) LIMIT :limit")
+
+TSVECTOR = ("to_tsvector('english', coalesce(name, '') || ' ' || "
+            "coalesce(description, ''))")
+
+POSTGRESQL_INDEX = [
+    "CREATE INDEX ix_{table}_search ON {table} USING gin (%s)" % TSVECTOR,
+]
+
+POSTGRESQL_SEARCH = (
+    "SELECT id FROM {table}, plainto_tsquery('english', :query) query "
+    "WHERE %s @@ query ORDER BY ts_rank(%s, query) DESC LIMIT :limit"
+    % (TSVECTOR, TSVECTOR))
+
+
+def has_fts5(connection):
+    try:
+        connection.execute(
+            'CREATE VIRTUAL TABLE temp.fts5_check USING fts5(content)')
+    except OperationalError:
+        return False
+    connection.execute('DROP TABLE temp.fts5_check')
+    return True
+
+
+def create_index(connection):
+    # create the search index for every searchable table
+    dialect = connection.dialect.name
+    if dialect == 'sqlite' and has_fts5(connection):
+        statements = SQLITE_INDEX
+    elif dialect == 'postgresql':
+        statements = POSTGRESQL_INDEX
+    else:
+        return
+    for table in TABLES:
+        for statement in statements:
+            connection.execute(statement.format(table=table.name))
+
+
+@event.listens_for(Base.metadata, 'after_create')
+def create_index_with_tables(target, connection, **kw):
+    create_index(connection)
+
+
+def fts_query(words):
+    # every word must match, as a prefix so partial words find results -
+    # each is quoted so nothing the user types is read as FTS5 syntax
+    return ' '.join('"%s"*' % word.replace('"', '""') for word in words)
+
+
+def search(session, model, query, limit):
+    # the rows of model (Category or Item) matching the query, best first
+    words = re.findall(r'\w+', query, re.UNICODE)
+    if not words:
+        return []
+    table = model.__table__.name
+    connection = session.connection()
+    dialect = connection.dialect.name
+
+    ids = None
+    if dialect == 'sqlite' and connection.dialect.has_table(
+            connection, table + '_fts'):
+        ids = [row[0] for row in connection.execute(
+            text(SQLITE_SEARCH.format(table=table)),
+            query=fts_query(words), limit=limit)]
+    elif dialect == 'postgresql':
+        ids = [row[0] for row in connection.execute(
+            text(POSTGRESQL_SEARCH.format(table=table)),
+            query=' '.join(words), limit=limit)]
+
+    rows = session.query(model)
+    if model is Item:
+        rows = rows.options(joinedload(Item.category))
+
+    if ids is None:
+        # no search index - match every word anywhere in the name or
+        # description, most recent first
+        for word in words:
+            pattern = '%' + word + '%'
+            rows = rows.filter(model.name.ilike(pattern) |
+                               model.description.ilike(pattern))
+        return rows.order_by(model.id.desc()).limit(limit).all()
+
+    if not ids:
+        return []
+    found = dict((row.id, row) for row in rows.filter(model.id.in_(ids)))
+    return [found[i] for i in ids if i in found]
@@ -0,0 +1,156 @@
+# Server-side sessions
+# The session cookie only holds a random session id; the session itself is
+# kept on the server in one of these stores, chosen by SESSION_STORE:
+#   memory - an LRU in each server process, for running a single process
+#   sqlite - a local sqlite file shared by every process on the machine
+#   redis  - a redis server shared by every machine (see cache.RedisCache)
+#   cookie - Flask's signed cookie sessions, as before
+# Session data is only written back when a request changes it.
+#
+# A session is given a new id whenever someone logs in or out (regenerate),
+# and its old record deleted, so a session id someone else planted or saw
+# beforehand is no use to them afterwards.
+import binascii
+import os
+import pickle
+import random
+import sqlite3
+import threading
+import time
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from cache import LocalCache, RedisCache
+
+
+class ServerSession(CallbackDict, SessionMixin):
+
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        # the id the session was opened with, if it has been given a new one
+        self.previous_sid = None
+
+    def regenerate(self):
+        if self.previous_sid is None:
+            self.previous_sid = self.sid
+        self.sid = new_sid()
+        self.modified = True
+
+
+def new_sid():
+    # 256 random bits, so session ids can't be guessed
+    return binascii.hexlify(os.urandom(32)).decode('ascii')
+
+
+def regenerate(session):
+    # give the login session a new id, keeping what's in it - Flask's cookie
+    # sessions have no id to change (session may be Flask's proxy for it)
+    if hasattr(session, 'regenerate'):
+        session.regenerate()
+
+
+class SqliteStore(object):
+    # key-value store in a sqlite file, with the same get/set/delete methods
+    # as the cache backends - every thread has its own connection
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.local = threading.local()
+        self.connection().execute(
+            'CREATE TABLE IF NOT EXISTS store '
+            '(key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+
+    def connection(self):
+        if not hasattr(self.local, 'connection'):
+            # autocommit, and write-ahead logging so readers don't wait
+            connection = sqlite3.connect(self.path, timeout=10,
+                                         isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return self.local.connection
+
+    def get(self, key):
+        row = self.connection().execute(
+            'SELECT value FROM store WHERE key = ? AND expires > ?',
+            (key, time.time())).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(bytes(row[0]))
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        connection = self.connection()
+        connection.execute(
+            'INSERT OR REPLACE INTO store VALUES (?, ?, ?)',
+            (key, sqlite3.Binary(pickle.dumps(value, 2)), time.time() + ttl))
+        # now and then clear out expired entries
+        if random.random() < 0.01:
+            connection.execute('DELETE FROM store WHERE expires < ?',
+                               (time.time(),))
+
+    def delete(self, key):
+        self.connection().execute('DELETE FROM store WHERE key = ?', (key,))
+
+
+class ServerSessionInterface(SessionInterface):
+
+    def __init__(self, store, lifetime):
+        self.store = store
+        self.lifetime = lifetime
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid:
+            data = self.store.get('session:' + sid)
+            if data is not None:
+                return ServerSession(data, sid=sid)
+        return ServerSession(sid=new_sid(), new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.previous_sid is not None and not session.new:
+            self.store.delete('session:' + session.previous_sid)
+        if not session:
+            # an emptied session, e.g. after logging out
+            if session.modified and not session.new:
+                self.store.delete('session:' + session.sid)
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain, path=path)
+            return
+        if not session.modified:
+            return
+
+        self.store.set('session:' + session.sid, dict(session),
+                       self.lifetime)
+        response.set_cookie(app.session_cookie_name, session.sid,
+                            expires=self.get_expiration_time(app, session),
+                            httponly=self.get_cookie_httponly(app),
+                            secure=self.get_cookie_secure(app),
+                            domain=domain, path=path)
+
+
+def make_session_interface(settings):
+    # the session interface for SESSION_STORE, or None to keep Flask's own
+    store = settings['SESSION_STORE']
+    lifetime = settings['SESSION_LIFETIME']
+    if store == 'memory':
+        backend = LocalCache(settings['SESSION_MAX_ENTRIES'], lifetime)
+    elif store == 'sqlite':
+        backend = SqliteStore(settings['SESSION_FILE'], lifetime)
+    elif store == 'redis':
+        backend = RedisCache(settings['CACHE_URL'], lifetime,
+                             prefix='catalog-session:')
+    elif store == 'cookie':
+        return None
+    else:
+        raise ValueError('unknown session store %r' % store)
+    return ServerSessionInterface(backend, lifetime)
@@ -0,0 +1,196 @@
+# Precomputed snapshot of the catalog for the read paths
+# The catalog_snapshot table holds a row per category with its item count and
+# the category's JSON, and the item_snapshot table a row per item with the
+# item's JSON, encoded exactly as Category.serialize and Item.serialize would
+# be.  The JSON endpoints send these bytes as they are, and the browse pages
+# read the item counts along with each category.
+#
+# The write routes call refresh_items() and refresh_categories() for the rows
+# they change just before committing, so the snapshot is updated in the same
+# transaction as the rows it describes.  Changing an item rewrites only that
+# item's row and adjusts its category's count in place; only renaming a
+# category re-encodes its items, as each item includes its category's name.
+# rebuild() makes the snapshot of whole categories again, for migrations and
+# bulk imports.
+#
+# A category's updated_at moves on whenever it or any item going into or out
+# of it changes, so it gives the Last-Modified of its pages (see
+# catalog.py).  A deleted category leaves no row behind, so snapshot_state
+# notes when one last went, for the pages listing every category.
+import json
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import select, func, bindparam
+from database_setup import Category, Item, CatalogSnapshot, ItemSnapshot
+from database_setup import SnapshotState
+from encoding import dumps
+
+categories = Category.__table__
+items = Item.__table__
+snapshots = CatalogSnapshot.__table__
+item_snapshots = ItemSnapshot.__table__
+states = SnapshotState.__table__
+
+# most values bound in one IN (...) list - older sqlite builds allow 999
+CHUNK_SIZE = 500
+
+# the columns of Category.serialize and Item.serialize, read straight from
+# the tables rather than through the ORM
+CATEGORY_COLUMNS = [categories.c.id, categories.c.name,
+                    categories.c.description, categories.c.icon,
+                    categories.c.user_id]
+ITEM_COLUMNS = [items.c.id, items.c.name, items.c.description,
+                items.c.price, items.c.image,
+                categories.c.name.label('category'), items.c.user_id]
+
+
+def serialize(row):
+    return dict(zip(row.keys(), row))
+
+
+def item_rows(session, *extra):
+    # a query for the ITEM_COLUMNS (and any extra columns) of items as plain
+    # row tuples, which are much cheaper to load than Item objects
+    return session.query(*(ITEM_COLUMNS + list(extra))).select_from(
+        items.join(categories, items.c.category_id == categories.c.id))
+
+
+def chunks(values):
+    values = list(values)
+    for start in range(0, len(values), CHUNK_SIZE):
+        yield values[start:start + CHUNK_SIZE]
+
+
+def encoded_items(connection, condition):
+    # the item_snapshot rows of the items matching condition
+    rows = connection.execute(
+        select(ITEM_COLUMNS + [items.c.category_id.label('category_id')]).
+        select_from(items.join(categories,
+                               items.c.category_id == categories.c.id)).
+        where(condition))
+    for row in rows:
+        item = serialize(row)
+        category_id = item.pop('category_id')
+        yield {'item_id': item['id'], 'category_id': category_id,
+               'item_json': dumps(item)}
+
+
+def add_to_counts(connection, changes):
+    # add to the item counts of categories - changes maps category ids to
+    # the number of items they gained (or lost)
+    now = datetime.utcnow()
+    for category_id, change in changes.items():
+        connection.execute(
+            snapshots.update().
+            where(snapshots.c.category_id == category_id).
+            values(item_count=snapshots.c.item_count + change,
+                   updated_at=now))
+
+
+def refresh_items(connection, item_ids):
+    # bring the snapshot rows of these items up to date, removing the rows of
+    # any that no longer exist
+    item_ids = set(int(i) for i in item_ids if i is not None)
+    changes = defaultdict(int)
+    for ids in chunks(item_ids):
+        for category_id, in connection.execute(
+                select([item_snapshots.c.category_id]).
+                where(item_snapshots.c.item_id.in_(ids))):
+            changes[category_id] -= 1
+        connection.execute(item_snapshots.delete().where(
+            item_snapshots.c.item_id.in_(ids)))
+        rows = list(encoded_items(connection, items.c.id.in_(ids)))
+        for row in rows:
+            changes[row['category_id']] += 1
+        if rows:
+            connection.execute(item_snapshots.insert(), rows)
+    add_to_counts(connection, changes)
+
+
+def refresh_categories(connection, category_ids):
+    # bring the snapshot rows of these categories up to date, removing the
+    # rows of any that no longer exist along with their items' rows
+    now = datetime.utcnow()
+    for category_id in set(int(i) for i in category_ids if i is not None):
+        category = connection.execute(select(CATEGORY_COLUMNS).where(
+            categories.c.id == category_id)).first()
+        if category is None:
+            connection.execute(snapshots.delete().where(
+                snapshots.c.category_id == category_id))
+            connection.execute(item_snapshots.delete().where(
+                item_snapshots.c.category_id == category_id))
+            category_deleted(connection, now)
+            continue
+
+        category = serialize(category)
+        old = connection.execute(select([snapshots.c.category_json]).where(
+            snapshots.c.category_id == category_id)).scalar()
+        if old is None:
+            # a new category has no items yet
+            connection.execute(snapshots.insert(), {
+                'category_id': category_id, 'item_count': 0,
+                'category_json': dumps(category), 'updated_at': now})
+            continue
+        connection.execute(
+            snapshots.update().
+            where(snapshots.c.category_id == category_id).
+            values(category_json=dumps(category), updated_at=now))
+        if json.loads(old)['name'] != category['name']:
+            rebuild(connection, [category_id])
+
+
+def category_deleted(connection, now):
+    # note when a category last went
+    if not connection.execute(states.update().where(states.c.id == 1).
+                              values(category_deleted_at=now)).rowcount:
+        connection.execute(states.insert(), {'id': 1,
+                                             'category_deleted_at': now})
+
+
+def rebuild(connection, category_ids=None):
+    # make the snapshot of these categories, or of every category, again
+    if category_ids is None:
+        connection.execute(item_snapshots.delete())
+        connection.execute(snapshots.delete())
+        category_ids = [row[0] for row in
+                        connection.execute(select([categories.c.id]))]
+    else:
+        category_ids = set(int(i) for i in category_ids if i is not None)
+        for ids in chunks(category_ids):
+            connection.execute(item_snapshots.delete().where(
+                item_snapshots.c.category_id.in_(ids)))
+            connection.execute(snapshots.delete().where(
+                snapshots.c.category_id.in_(ids)))
+
+    now = datetime.utcnow()
+    for ids in chunks(category_ids):
+        rows = [{'category_id': row.id, 'item_count': 0,
+                 'category_json': dumps(serialize(row)), 'updated_at': now}
+                for row in connection.execute(select(CATEGORY_COLUMNS).where(
+                    categories.c.id.in_(ids)))]
+        if not rows:
+            continue
+        connection.execute(snapshots.insert(), rows)
+
+        # the items are encoded and written a batch at a time
+        batch = []
+        for row in encoded_items(connection, items.c.category_id.in_(ids)):
+            batch.append(row)
+            if len(batch) == 10000:
+                connection.execute(item_snapshots.insert(), batch)
+                batch = []
+        if batch:
+            connection.execute(item_snapshots.insert(), batch)
+
+        counts = connection.execute(
+            select([items.c.category_id, func.count(items.c.id)]).
+            where(items.c.category_id.in_(ids)).
+            group_by(items.c.category_id))
+        counts = [{'_id': category_id, 'item_count': count}
+                  for category_id, count in counts]
+        if counts:
+            connection.execute(
+                snapshots.update().
+                where(snapshots.c.category_id == bindparam('_id')).
+                values(item_count=bindparam('item_count')), counts)
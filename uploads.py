@@ -0,0 +1,161 @@
+# Storage for uploaded images
+# An upload is written to a part file in the upload folder as the form is
+# parsed (see UploadRequest), up to a maximum size, hashing it on the way,
+# and then stored by renaming it to the SHA-256 hash of its content in a two
+# level directory layout, e.g. 3f/a2/3fa2...c9.jpg, so a picture uploaded
+# for many items is only kept once.
+#
+# Files are shared, so they may only be deleted once no category or item
+# refers to them any more (see removeUploads in catalog.py).  Deleting one
+# can race with an upload of the same content, which finds the file already
+# stored: the remover sets the file aside before looking for references and
+# only deletes it if there are none, and the upload keeps its part file
+# until its own reference has been committed, then puts the file back if it
+# has gone (restore).
+import errno
+import hashlib
+import os
+import tempfile
+
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge
+
+CHUNK_SIZE = 64 * 1024
+
+
+def path_for(digest, extension):
+    return '%s/%s/%s.%s' % (digest[:2], digest[2:4], digest, extension)
+
+
+class PartFile(object):
+    # a temporary file in the upload folder that an upload is written to,
+    # removed when it is closed unless it has been stored by then
+
+    def __init__(self, folder, max_size):
+        handle, self.path = tempfile.mkstemp(suffix='.part', dir=folder)
+        self.file = os.fdopen(handle, 'w+b')
+        self.folder = folder
+        self.max_size = max_size
+        self.size = 0
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            # the parser drops the file without closing it
+            self.close()
+            raise RequestEntityTooLarge()
+        self.digest.update(data)
+        self.file.write(data)
+
+    def __getattr__(self, name):
+        # everything else - read, seek and so on - goes to the file
+        return getattr(self.file, name)
+
+    def store(self, path):
+        # move the part file to path, where it is kept
+        self.file.flush()
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        os.rename(self.path, path)
+        self.path = None
+
+    def close(self):
+        self.file.close()
+        if self.path is not None:
+            os.remove(self.path)
+            self.path = None
+
+
+class UploadRequest(Request):
+    # a request that writes uploaded files straight to part files, rather
+    # than to memory or an anonymous temporary file that save() would then
+    # have to copy.  Its part files are all closed with the request, even
+    # those of a form that failed to parse and never reached request.files.
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        if not filename:
+            # a file field left empty
+            return Request._get_file_stream(
+                self, total_content_length, content_type, filename,
+                content_length)
+        part = PartFile(current_app.config['UPLOAD_FOLDER'],
+                        current_app.config['MAX_UPLOAD_SIZE'])
+        if not hasattr(self, 'part_files'):
+            self.part_files = []
+        self.part_files.append(part)
+        return part
+
+    def close(self):
+        try:
+            Request.close(self)
+        finally:
+            for part in getattr(self, 'part_files', ()):
+                part.close()
+
+
+def save(userfile, folder, max_size):
+    # store an uploaded file, returning its name relative to the upload folder
+    # and whether it is new (False if the same content was already stored)
+    extension = userfile.filename.rsplit('.', 1)[1].lower()
+    part = userfile.stream
+    if not (isinstance(part, PartFile) and
+            os.path.abspath(part.folder) == os.path.abspath(folder)):
+        # not parsed by UploadRequest - copy it to a part file, which is then
+        # closed along with the upload
+        part = PartFile(folder, max_size)
+        try:
+            while True:
+                chunk = userfile.stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                part.write(chunk)
+        except Exception:
+            part.close()
+            raise
+        userfile.stream.close()
+        userfile.stream = part
+
+    filename = path_for(part.digest.hexdigest(), extension)
+    path = os.path.join(folder, filename)
+    if os.path.isfile(path):
+        # the part file is kept until the request is over, for restore
+        return filename, False
+    part.store(path)
+    return filename, True
+
+
+def restore(userfile, folder, filename):
+    # put back a file that save() found already stored, if it has been
+    # removed since - called once the reference to it has been committed.
+    # Returns whether it was put back.
+    path = os.path.join(folder, filename)
+    part = userfile.stream
+    if (os.path.isfile(path) or not isinstance(part, PartFile) or
+            part.path is None):
+        return False
+    part.store(path)
+    return True
+
+
+def set_aside(folder, filename):
+    # move a stored file out of the way before checking whether anything
+    # still uses it, returning where it went, or None if it isn't there
+    path = os.path.join(folder, filename)
+    aside = path + '.removing'
+    try:
+        os.rename(path, aside)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    return aside
+
+
+def put_back(aside, folder, filename):
+    # return a file set aside to its place, as something still uses it
+    os.rename(aside, os.path.join(folder, filename))
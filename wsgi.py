@@ -0,0 +1,8 @@
+# WSGI entry point for running the catalog in production, e.g.
+#   gunicorn -c gunicorn.conf.py wsgi:app
+# Settings come from CATALOG_ environment variables (see config.py), and
+# CATALOG_SECRET_KEY must be set.  Each worker process imports this module
+# and gets its app ready with create_app.
+from catalog import create_app
+
+app = create_app()